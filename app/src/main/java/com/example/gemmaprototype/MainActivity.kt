@@ -18,6 +18,7 @@ import com.example.gemmaprototype.utils.DeviceCapabilityChecker
 import com.example.gemmaprototype.utils.PermissionManager
 import kotlinx.coroutines.Dispatchers
 import kotlinx.coroutines.flow.collectLatest
+import kotlinx.coroutines.flow.first
 import kotlinx.coroutines.launch
 import kotlinx.coroutines.withContext
 import java.util.Date
@@ -208,6 +209,9 @@ class MainActivity : AppCompatActivity() {
 
                 gemmaManager = GemmaModelManager(this@MainActivity)
                 val initialized = gemmaManager!!.initialize()
+                if (initialized) {
+                    restoreConversation()
+                }
 
                 withContext(Dispatchers.Main) {
                     if (initialized) {
@@ -239,6 +243,29 @@ class MainActivity : AppCompatActivity() {
         }
     }
     
+    /**
+     * 按數據庫中當前會話的消息重建模型的對話歷史
+     * 未完成和生成失敗的回覆不計入歷史，與生成失敗時模型管理器回滾歷史一致
+     */
+    private suspend fun restoreConversation() {
+        if (gemmaManager?.getConversationSessionId() == currentSessionId) return
+
+        val messages = database.chatDao().getMessagesForSession(currentSessionId).first()
+        val turns = mutableListOf<Pair<String, String>>()
+        var pendingUserText: String? = null
+        for (message in messages) {
+            if (message.isFromUser) {
+                pendingUserText = message.content
+            } else if (pendingUserText != null && !message.isProcessing &&
+                !message.content.startsWith(GemmaModelManager.GENERATION_FAILED_PREFIX)
+            ) {
+                turns.add(pendingUserText to message.content)
+                pendingUserText = null
+            }
+        }
+        gemmaManager?.startConversation(currentSessionId, turns)
+    }
+    
     /**
      * 發送消息
      */
@@ -304,6 +331,9 @@ class MainActivity : AppCompatActivity() {
         isGenerating = true
 
         try {
+            // 會話切換後模型的對話歷史需要跟隨當前會話
+            restoreConversation()
+
             // 構建完整的提示詞
             val fullPrompt = buildPromptWithMedia(prompt, attachments)
 
@@ -341,7 +371,7 @@ class MainActivity : AppCompatActivity() {
         } catch (e: Exception) {
             val errorMessage = aiMessage.copy(
                 id = messageId,
-                content = "生成失敗: ${e.message}",
+                content = "${GemmaModelManager.GENERATION_FAILED_PREFIX}${e.message}",
                 isProcessing = false
             )
             database.chatDao().updateMessage(errorMessage)
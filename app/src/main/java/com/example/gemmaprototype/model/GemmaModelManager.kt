@@ -4,6 +4,7 @@ import android.content.Context
 import android.util.Log
 import com.example.gemmaprototype.utils.DeviceCapabilityChecker
 import com.example.gemmaprototype.utils.ModelUtils
+import kotlinx.coroutines.CancellationException
 import kotlinx.coroutines.Dispatchers
 import kotlinx.coroutines.withContext
 import org.tensorflow.lite.Interpreter
@@ -20,6 +21,16 @@ import java.nio.ByteOrder
 class GemmaModelManager(private val context: Context) {
     private var interpreter: Interpreter? = null
     private var tokenizer: GemmaTokenizer? = null
+    private var promptTable: PromptTemplateTable? = null
+    
+    // 已分詞的對話歷史（以 BOS 開頭），每輪只追加新消息和模板片段
+    private val conversationTokens = mutableListOf<Int>()
+    // 每輪用戶消息在 conversationTokens 中的起始位置，超長時按輪次從最早的開始裁剪
+    private val turnStarts = mutableListOf<Int>()
+    // 沒有預分詞表時在運行時分詞的模板片段
+    private val templateCache = mutableMapOf<String, List<Int>>()
+    // conversationTokens 對應的聊天會話
+    private var conversationSessionId: Long? = null
     private var gpuDelegate: GpuDelegate? = null
     private var nnApiDelegate: NnApiDelegate? = null
     
@@ -29,6 +40,8 @@ class GemmaModelManager(private val context: Context) {
     
     companion object {
         private const val TAG = "GemmaModelManager"
+        // 生成失敗時返回文本的前綴，恢復對話歷史時據此跳過失敗的輪次
+        const val GENERATION_FAILED_PREFIX = "生成失敗: "
     }
     
     /**
@@ -50,6 +63,9 @@ class GemmaModelManager(private val context: Context) {
             tokenizer = GemmaTokenizer(context)
             Log.d(TAG, "Tokenizer initialized with vocab size: ${tokenizer?.getVocabSize()}")
             
+            // 加載預分詞的聊天模板和停止序列表
+            promptTable = loadPromptTable()
+            
             // 加載模型
             val modelLoaded = loadModel()
             if (!modelLoaded) {
@@ -65,6 +81,21 @@ class GemmaModelManager(private val context: Context) {
         }
     }
     
+    /**
+     * 加載預分詞表，詞彙表不匹配時不使用
+     */
+    private fun loadPromptTable(): PromptTemplateTable? {
+        val table = PromptTemplateTable.fromAssets(context) ?: return null
+        
+        if (!table.matchesVocabulary(context)) {
+            Log.w(TAG, "Prompt tables were built for a different vocabulary, ignoring")
+            return null
+        }
+        
+        Log.d(TAG, "Prompt tables loaded with ${table.getStopSequenceCount()} stop sequences")
+        return table
+    }
+    
     /**
      * 加載 TensorFlow Lite 模型
      */
@@ -201,30 +232,144 @@ class GemmaModelManager(private val context: Context) {
             return@withContext "模型未正確加載"
         }
         
+        // 生成未完成（失敗或被取消）時恢復對話歷史，避免留下未結束的模型輪次
+        val savedTokens = conversationTokens.toList()
+        val savedTurnStarts = turnStarts.toList()
+        var completed = false
+        
         try {
             Log.d(TAG, "Generating text for prompt: $prompt")
             
             // 編碼輸入
-            val inputIds = tokenizer!!.encode(prompt)
+            val inputIds = buildPromptTokens(prompt, maxTokens)
             Log.d(TAG, "Input tokens: ${inputIds.size}")
             
             // 模擬文本生成（實際實現需要根據具體模型調整）
-            val result = simulateTextGeneration(prompt, maxTokens, onProgress)
+            val generatedTokens = mutableListOf<Int>()
+            val result = simulateTextGeneration(
+                prompt, maxTokens, promptTable?.newStopMatcher(), generatedTokens, onProgress
+            )
+            // 停止序列已被截掉，補上完整的輪次結束標記
+            appendModelTurn(generatedTokens)
+            completed = true
             
             Log.d(TAG, "Generated text: $result")
             result
+        } catch (e: CancellationException) {
+            throw e
         } catch (e: Exception) {
             Log.e(TAG, "Text generation failed", e)
-            "生成失敗: ${e.message}"
+            "$GENERATION_FAILED_PREFIX${e.message}"
+        } finally {
+            if (!completed) {
+                conversationTokens.clear()
+                conversationTokens.addAll(savedTokens)
+                turnStarts.clear()
+                turnStarts.addAll(savedTurnStarts)
+            }
         }
     }
     
+    /**
+     * 模板片段的 token：優先使用預分詞表，否則在運行時分詞並緩存
+     * 兩種方式得到的 token 相同，模型看到的提示與是否有預分詞表無關
+     */
+    private fun templateFragment(name: String): List<Int> {
+        promptTable?.let { return it.fragment(name).asList() }
+        
+        return templateCache.getOrPut(name) {
+            tokenizer!!.encodeTemplate(PromptTemplateTable.TEMPLATE_TEXTS.getValue(name))
+        }
+    }
+    
+    /**
+     * 組裝本輪提示的 token：拼接緩存的對話歷史、模板片段和新消息
+     * 超出長度時按輪次裁剪最早的對話，BOS 始終保留
+     */
+    private fun buildPromptTokens(prompt: String, maxTokens: Int): List<Int> {
+        val bos = templateFragment(PromptTemplateTable.BOS)
+        if (conversationTokens.isEmpty()) {
+            conversationTokens.addAll(bos)
+        }
+        
+        val userTurnStart = templateFragment(PromptTemplateTable.USER_TURN_START)
+        val turnEnd = templateFragment(PromptTemplateTable.TURN_END)
+        val modelTurnStart = templateFragment(PromptTemplateTable.MODEL_TURN_START)
+        
+        // 為生成的 token 預留空間；單條消息本身過長時只保留其末尾
+        val budget = maxOf(0, maxSequenceLength - maxTokens)
+        val templateSize = bos.size + userTurnStart.size + turnEnd.size + modelTurnStart.size
+        val messageTokens = tokenizer!!.encodeText(prompt).takeLast(maxOf(0, budget - templateSize))
+        
+        turnStarts.add(conversationTokens.size)
+        conversationTokens.addAll(userTurnStart)
+        conversationTokens.addAll(messageTokens)
+        conversationTokens.addAll(turnEnd)
+        conversationTokens.addAll(modelTurnStart)
+        
+        trimConversation(bos.size, budget)
+        return conversationTokens.toList()
+    }
+    
+    /**
+     * 從最早的輪次開始整輪刪除，直到不超過預算或只剩當前輪
+     */
+    private fun trimConversation(bosSize: Int, budget: Int) {
+        while (conversationTokens.size > budget && turnStarts.size > 1) {
+            val removed = turnStarts[1] - bosSize
+            conversationTokens.subList(bosSize, turnStarts[1]).clear()
+            turnStarts.removeAt(0)
+            for (i in turnStarts.indices) {
+                turnStarts[i] -= removed
+            }
+        }
+    }
+    
+    /**
+     * 將模型回覆的 token 追加到對話歷史
+     */
+    private fun appendModelTurn(generatedTokens: List<Int>) {
+        conversationTokens.addAll(generatedTokens)
+        conversationTokens.addAll(templateFragment(PromptTemplateTable.TURN_END))
+    }
+    
+    /**
+     * 開始新的對話
+     */
+    fun resetConversation() {
+        conversationTokens.clear()
+        turnStarts.clear()
+        conversationSessionId = null
+    }
+    
+    /**
+     * 切換到指定會話：清空當前歷史，並按已保存的（用戶消息, 模型回覆）輪次重建
+     * 已是該會話時保留現有歷史
+     */
+    fun startConversation(sessionId: Long, turns: List<Pair<String, String>> = emptyList()) {
+        if (sessionId == conversationSessionId || tokenizer == null) return
+        
+        resetConversation()
+        for ((userText, modelText) in turns) {
+            buildPromptTokens(userText, maxNewTokens)
+            appendModelTurn(tokenizer!!.encodeText(modelText))
+        }
+        conversationSessionId = sessionId
+    }
+    
+    /**
+     * 當前對話歷史所屬的會話，尚未開始時為 null
+     */
+    fun getConversationSessionId(): Long? = conversationSessionId
+    
     /**
      * 模擬文本生成（佔位符實現）
      */
     private suspend fun simulateTextGeneration(
         prompt: String, 
         maxTokens: Int,
+        stopMatcher: PromptTemplateTable.StopMatcher?,
+        generatedTokens: MutableList<Int>,
         onProgress: ((String) -> Unit)?
     ): String = withContext(Dispatchers.IO) {
         
@@ -239,22 +384,62 @@ class GemmaModelManager(private val context: Context) {
         val selectedResponse = responses.random()
         val words = selectedResponse.split(" ")
         val result = StringBuilder()
+        // 停止序列可能跨越多個詞，匹配到前綴時先暫存這些詞（及其最後一個 token 的結束位置），確定不是停止序列後再輸出
+        val pendingWords = mutableListOf<Pair<String, Int>>()
         
         // 模擬逐詞生成
-        for (i in words.indices) {
-            if (i > 0) result.append(" ")
-            result.append(words[i])
+        var stopped = false
+        for (word in words) {
+            if (generatedTokens.size >= maxTokens) break
+            
+            // 逐 token 檢查停止序列，命中時從輸出中截掉整個停止序列（包括之前已輸出的前綴）
+            for (token in tokenizer?.encodeText(word) ?: emptyList()) {
+                generatedTokens.add(token)
+                val stopIndex = stopMatcher?.accept(token) ?: -1
+                if (stopIndex >= 0) {
+                    val stopLength = promptTable!!.stopSequenceLength(stopIndex)
+                    generatedTokens.subList(maxOf(0, generatedTokens.size - stopLength), generatedTokens.size).clear()
+                    // 與停止序列重疊的暫存詞直接丟棄，之前的照常輸出
+                    pendingWords.removeAll { it.second > generatedTokens.size }
+                    appendWords(result, pendingWords)
+                    onProgress?.invoke(result.toString())
+                    stopped = true
+                    break
+                }
+            }
+            if (stopped) break
             
-            // 通知進度
-            onProgress?.invoke(result.toString())
+            pendingWords.add(word to generatedTokens.size)
+            if (stopMatcher?.isPartialMatch() != true) {
+                appendWords(result, pendingWords)
+                
+                // 通知進度
+                onProgress?.invoke(result.toString())
+            }
             
             // 模擬生成延遲
             kotlinx.coroutines.delay(200)
         }
         
+        // 生成結束時未完成的前綴不是停止序列，照常輸出
+        if (!stopped) {
+            appendWords(result, pendingWords)
+        }
+        
         result.toString()
     }
     
+    /**
+     * 將暫存的詞以空格分隔追加到結果並清空暫存
+     */
+    private fun appendWords(result: StringBuilder, words: MutableList<Pair<String, Int>>) {
+        for ((word, _) in words) {
+            if (result.isNotEmpty()) result.append(" ")
+            result.append(word)
+        }
+        words.clear()
+    }
+    
     /**
      * 檢查模型是否已加載
      */
@@ -274,6 +459,11 @@ class GemmaModelManager(private val context: Context) {
         nnApiDelegate = null
         
         tokenizer = null
+        promptTable = null
+        conversationTokens.clear()
+        turnStarts.clear()
+        templateCache.clear()
+        conversationSessionId = null
         
         Log.d(TAG, "Resources cleaned up")
     }
@@ -21,6 +21,14 @@ class GemmaTokenizer(private val context: Context) {
     private val unkToken: Int by lazy { vocabulary["<unk>"] ?: 3 }
     private val padToken: Int by lazy { vocabulary["<pad>"] ?: 0 }
     
+    // 詞彙表中的特殊標記（如 <start_of_turn>），模板分詞時整體匹配，長的優先
+    private val specialTokenPattern: Regex? by lazy {
+        val specials = vocabulary.keys
+            .filter { it.length > 2 && it.startsWith("<") && it.endsWith(">") }
+            .sortedByDescending { it.length }
+        if (specials.isEmpty()) null else Regex(specials.joinToString("|") { Regex.escape(it) })
+    }
+    
     companion object {
         private const val TAG = "GemmaTokenizer"
         private const val VOCAB_FILE = "vocab.json"
@@ -142,6 +150,34 @@ class GemmaTokenizer(private val context: Context) {
         return tokens.take(MAX_SEQUENCE_LENGTH)
     }
     
+    /**
+     * 編碼文本片段為 token IDs（不加 BOS/EOS，不截斷）
+     * 用於把新消息拼接到已緩存的對話 token 之後
+     */
+    fun encodeText(text: String): List<Int> {
+        if (text.isBlank()) return emptyList()
+        
+        return text.trim().split(Regex("\\s+")).flatMap { encodeWord(it) }
+    }
+    
+    /**
+     * 編碼聊天模板片段：特殊標記整體匹配，其餘部分按 encodeText 分詞
+     * 與 scripts/build_prompt_tables.py 生成預分詞表的邏輯一致
+     */
+    fun encodeTemplate(text: String): List<Int> {
+        val pattern = specialTokenPattern ?: return encodeText(text)
+        
+        val tokens = mutableListOf<Int>()
+        var start = 0
+        for (match in pattern.findAll(text)) {
+            tokens.addAll(encodeText(text.substring(start, match.range.first)))
+            tokens.add(vocabulary.getValue(match.value))
+            start = match.range.last + 1
+        }
+        tokens.addAll(encodeText(text.substring(start)))
+        return tokens
+    }
+    
     /**
      * 編碼單個詞
      */
@@ -0,0 +1,163 @@
+package com.example.gemmaprototype.model
+
+import android.content.Context
+import android.util.Log
+import java.io.IOException
+import java.nio.ByteBuffer
+import java.nio.ByteOrder
+import java.util.zip.CRC32
+
+/**
+ * 預分詞的聊天模板和停止序列表
+ * 由 scripts/build_prompt_tables.py 生成，格式見該腳本的 serialize_tables
+ */
+class PromptTemplateTable private constructor(
+    val vocabCrc32: Long,
+    private val fragments: Map<String, IntArray>,
+    private val stopSequences: List<Pair<String, IntArray>>,
+    private val alphabetColumns: Map<Int, Int>,
+    private val stateOutputs: IntArray,
+    private val transitions: IntArray
+) {
+    
+    companion object {
+        private const val TAG = "PromptTemplateTable"
+        const val ASSET_FILE = "prompt_tables.bin"
+        private const val VOCAB_FILE = "vocab.json"
+        private const val MAGIC = "GCTB"
+        private const val VERSION = 1
+        
+        const val BOS = "bos"
+        const val USER_TURN_START = "user_turn_start"
+        const val MODEL_TURN_START = "model_turn_start"
+        const val TURN_END = "turn_end"
+        
+        // 片段原文，沒有預分詞表時在運行時分詞，與 build_prompt_tables.py 的 CHAT_TEMPLATE_FRAGMENTS 一致
+        val TEMPLATE_TEXTS = mapOf(
+            BOS to "<bos>",
+            USER_TURN_START to "<start_of_turn>user\n",
+            MODEL_TURN_START to "<start_of_turn>model\n",
+            TURN_END to "<end_of_turn>\n"
+        )
+        
+        /**
+         * 從 assets 加載，文件不存在或格式錯誤時返回 null
+         */
+        fun fromAssets(context: Context): PromptTemplateTable? {
+            return try {
+                context.assets.open(ASSET_FILE).use { input ->
+                    parse(input.readBytes())
+                }
+            } catch (e: IOException) {
+                Log.w(TAG, "Prompt tables not found in assets, falling back to full tokenization")
+                null
+            } catch (e: Exception) {
+                Log.e(TAG, "Invalid prompt tables", e)
+                null
+            }
+        }
+        
+        /**
+         * 解析二進制表（小端）
+         */
+        fun parse(bytes: ByteArray): PromptTemplateTable {
+            val buffer = ByteBuffer.wrap(bytes).order(ByteOrder.LITTLE_ENDIAN)
+            
+            val magic = ByteArray(4).also { buffer.get(it) }
+            require(String(magic, Charsets.US_ASCII) == MAGIC) { "Bad magic" }
+            val version = buffer.short.toInt() and 0xFFFF
+            require(version == VERSION) { "Unsupported version: $version" }
+            buffer.short // reserved
+            val vocabCrc32 = buffer.int.toLong() and 0xFFFFFFFFL
+            
+            val fragments = mutableMapOf<String, IntArray>()
+            repeat(buffer.int) {
+                val name = readString(buffer)
+                fragments[name] = readIds(buffer)
+            }
+            
+            val stopSequences = mutableListOf<Pair<String, IntArray>>()
+            repeat(buffer.int) {
+                val text = readString(buffer)
+                stopSequences.add(text to readIds(buffer))
+            }
+            
+            val alphabet = readIds(buffer)
+            val alphabetColumns = HashMap<Int, Int>(alphabet.size * 2)
+            alphabet.forEachIndexed { column, tokenId -> alphabetColumns[tokenId] = column }
+            
+            val stateOutputs = readIds(buffer)
+            val transitions = IntArray(stateOutputs.size * alphabet.size) { buffer.int }
+            
+            return PromptTemplateTable(
+                vocabCrc32, fragments, stopSequences, alphabetColumns, stateOutputs, transitions
+            )
+        }
+        
+        private fun readString(buffer: ByteBuffer): String {
+            val length = buffer.short.toInt() and 0xFFFF
+            val bytes = ByteArray(length).also { buffer.get(it) }
+            return String(bytes, Charsets.UTF_8)
+        }
+        
+        private fun readIds(buffer: ByteBuffer): IntArray {
+            val count = buffer.int
+            return IntArray(count) { buffer.int }
+        }
+    }
+    
+    /**
+     * 檢查表是否由當前 assets 中的詞彙表生成
+     */
+    fun matchesVocabulary(context: Context): Boolean {
+        return try {
+            val crc = CRC32()
+            context.assets.open(VOCAB_FILE).use { crc.update(it.readBytes()) }
+            crc.value == vocabCrc32
+        } catch (e: IOException) {
+            false
+        }
+    }
+    
+    /**
+     * 獲取模板片段的 token id，不存在時返回空數組
+     */
+    fun fragment(name: String): IntArray = fragments[name] ?: IntArray(0)
+    
+    /**
+     * 停止序列的 token 長度，用於從輸出中截掉停止序列
+     */
+    fun stopSequenceLength(index: Int): Int = stopSequences[index].second.size
+    
+    fun getStopSequenceCount(): Int = stopSequences.size
+    
+    /**
+     * 為一次生成創建停止序列匹配器
+     */
+    fun newStopMatcher(): StopMatcher = StopMatcher()
+    
+    /**
+     * 停止序列匹配器：每個 token 一次哈希查找和一次數組索引
+     */
+    inner class StopMatcher {
+        private var state = 0
+        
+        /**
+         * 輸入一個生成的 token，返回完成匹配的停止序列索引，未匹配返回 -1
+         */
+        fun accept(tokenId: Int): Int {
+            val column = alphabetColumns[tokenId]
+            state = if (column == null) 0 else transitions[state * alphabetColumns.size + column]
+            return stateOutputs[state]
+        }
+        
+        /**
+         * 已輸入的 token 末尾是否為某個停止序列的前綴，此時對應的文本應暫不輸出
+         */
+        fun isPartialMatch(): Boolean = state != 0
+        
+        fun reset() {
+            state = 0
+        }
+    }
+}
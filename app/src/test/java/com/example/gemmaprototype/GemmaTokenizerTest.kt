@@ -112,4 +112,11 @@ class GemmaTokenizerTest {
         // 未知詞應該被分解為字符或使用 UNK token
         assertTrue("Should contain some tokens", tokens.size > 2) // 至少 BOS + content + EOS
     }
+    
+    @Test
+    fun testEncodeTemplateMatchesSpecialTokens() {
+        // 詞彙表中的特殊標記整體匹配，其餘部分與 encodeText 一致
+        assertEquals(listOf(1, 4, 2), tokenizer.encodeTemplate("<bos>hello\n<eos>"))
+        assertEquals(tokenizer.encodeText("hello world"), tokenizer.encodeTemplate("hello world"))
+    }
 }
@@ -0,0 +1,116 @@
+package com.example.gemmaprototype
+
+import com.example.gemmaprototype.model.PromptTemplateTable
+import org.junit.Before
+import org.junit.Test
+import org.junit.Assert.*
+import java.nio.ByteBuffer
+import java.nio.ByteOrder
+
+/**
+ * PromptTemplateTable 單元測試
+ */
+class PromptTemplateTableTest {
+    
+    private lateinit var table: PromptTemplateTable
+    
+    @Before
+    fun setUp() {
+        // 停止序列 0: [7, 8]，停止序列 1: [2]
+        // 字母表 [2, 7, 8]；狀態 0 根，1 讀入 7，2 讀入 7 8，3 讀入 2
+        val buffer = ByteBuffer.allocate(512).order(ByteOrder.LITTLE_ENDIAN)
+        buffer.put("GCTB".toByteArray(Charsets.US_ASCII))
+        buffer.putShort(1)
+        buffer.putShort(0)
+        buffer.putInt(0x12345678)
+        
+        buffer.putInt(2)
+        putString(buffer, "bos")
+        putIds(buffer, intArrayOf(1))
+        putString(buffer, "turn_end")
+        putIds(buffer, intArrayOf(7, 8))
+        
+        buffer.putInt(2)
+        putString(buffer, "<end_of_turn>")
+        putIds(buffer, intArrayOf(7, 8))
+        putString(buffer, "<eos>")
+        putIds(buffer, intArrayOf(2))
+        
+        putIds(buffer, intArrayOf(2, 7, 8))
+        putIds(buffer, intArrayOf(-1, -1, 0, 1))
+        val transitions = intArrayOf(
+            3, 1, 0,
+            3, 1, 2,
+            3, 1, 0,
+            3, 1, 0
+        )
+        transitions.forEach { buffer.putInt(it) }
+        
+        table = PromptTemplateTable.parse(buffer.array().copyOf(buffer.position()))
+    }
+    
+    private fun putString(buffer: ByteBuffer, text: String) {
+        val bytes = text.toByteArray(Charsets.UTF_8)
+        buffer.putShort(bytes.size.toShort())
+        buffer.put(bytes)
+    }
+    
+    private fun putIds(buffer: ByteBuffer, ids: IntArray) {
+        buffer.putInt(ids.size)
+        ids.forEach { buffer.putInt(it) }
+    }
+    
+    @Test
+    fun testFragments() {
+        assertArrayEquals(intArrayOf(1), table.fragment("bos"))
+        assertArrayEquals(intArrayOf(7, 8), table.fragment("turn_end"))
+        assertEquals("Unknown fragment should be empty", 0, table.fragment("missing").size)
+        assertEquals(0x12345678L, table.vocabCrc32)
+    }
+    
+    @Test
+    fun testStopSequenceMatching() {
+        val matcher = table.newStopMatcher()
+        
+        assertEquals(-1, matcher.accept(5))
+        assertEquals(-1, matcher.accept(7))
+        assertEquals("Should match <end_of_turn>", 0, matcher.accept(8))
+        assertEquals(2, table.stopSequenceLength(0))
+    }
+    
+    @Test
+    fun testSingleTokenStopSequence() {
+        val matcher = table.newStopMatcher()
+        
+        assertEquals(-1, matcher.accept(7))
+        assertEquals("Should match <eos> after partial match", 1, matcher.accept(2))
+    }
+    
+    @Test
+    fun testPartialMatchResetsOnUnknownToken() {
+        val matcher = table.newStopMatcher()
+        
+        assertEquals(-1, matcher.accept(7))
+        assertEquals(-1, matcher.accept(99))
+        assertEquals("8 alone should not match", -1, matcher.accept(8))
+        assertEquals(-1, matcher.accept(7))
+        assertEquals(-1, matcher.accept(7))
+        assertEquals("Repeated prefix should still match", 0, matcher.accept(8))
+    }
+    
+    @Test
+    fun testIsPartialMatch() {
+        val matcher = table.newStopMatcher()
+        
+        assertFalse(matcher.isPartialMatch())
+        matcher.accept(7)
+        assertTrue("Prefix of [7, 8] should be pending", matcher.isPartialMatch())
+        matcher.accept(5)
+        assertFalse("Unrelated token should leave no pending prefix", matcher.isPartialMatch())
+    }
+    
+    @Test
+    fun testStopSequenceCount() {
+        assertEquals(2, table.getStopSequenceCount())
+    }
+}
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+聊天模板和停止序列 token 表生成腳本
+用應用內置的詞彙表預先分詞 Gemma 聊天模板片段和停止序列，
+生成緊湊的二進制表（含基於 token id 的 Aho-Corasick 自動機），
+應用端每輪只需拼接緩存的 id 數組，停止檢測每個 token O(1)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import argparse
+from collections import deque
+
+PROMPT_TABLES_FILE = "prompt_tables.bin"
+TABLE_MAGIC = b"GCTB"
+TABLE_VERSION = 1
+
+# Gemma 聊天模板片段
+CHAT_TEMPLATE_FRAGMENTS = {
+    "bos": "<bos>",
+    "user_turn_start": "<start_of_turn>user\n",
+    "model_turn_start": "<start_of_turn>model\n",
+    "turn_end": "<end_of_turn>\n",
+}
+
+DEFAULT_STOP_SEQUENCES = ["<end_of_turn>", "<eos>"]
+
+
+def load_vocab(vocab_path):
+    """讀取詞彙表，返回 (詞彙表字典, crc32)"""
+    with open(vocab_path, 'rb') as f:
+        raw = f.read()
+    return json.loads(raw.decode('utf-8')), zlib.crc32(raw)
+
+
+class AppTokenizer:
+    """
+    與 GemmaTokenizer.kt 一致的分詞邏輯：按空白切詞，整詞命中則用整詞，否則逐字符
+    模板片段中的特殊標記（如 <start_of_turn>）若在詞彙表中則整體匹配
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.unk_id = vocab.get("<unk>", 3)
+        specials = sorted(
+            (token for token in vocab if len(token) > 2 and token.startswith("<") and token.endswith(">")),
+            key=len, reverse=True
+        )
+        self.special_pattern = re.compile("(" + "|".join(map(re.escape, specials)) + ")") if specials else None
+
+    def encode_text(self, text):
+        """對應 GemmaTokenizer.encodeText：不加 BOS/EOS"""
+        ids = []
+        for word in text.strip().split():
+            if word in self.vocab:
+                ids.append(self.vocab[word])
+            else:
+                ids.extend(self.vocab.get(char, self.unk_id) for char in word)
+        return ids
+
+    def encode_fragment(self, text):
+        """模板片段分詞：特殊標記整體匹配，其餘部分按應用邏輯分詞"""
+        if self.special_pattern is None:
+            return self.encode_text(text)
+
+        ids = []
+        for part in self.special_pattern.split(text):
+            if part in self.vocab:
+                ids.append(self.vocab[part])
+            elif part:
+                ids.extend(self.encode_text(part))
+        return ids
+
+
+def build_automaton(patterns):
+    """
+    在 token id 上構建 Aho-Corasick 自動機並展開為稠密 DFA
+    只有出現在模式中的 token 進入字母表，其餘 token 直接回到根狀態
+    返回 (字母表, 狀態輸出, 轉移表[state][column])
+    """
+    alphabet = sorted({token for pattern in patterns for token in pattern})
+    column = {token: i for i, token in enumerate(alphabet)}
+
+    goto = [{}]
+    output = [-1]
+    for index, pattern in enumerate(patterns):
+        if not pattern:
+            continue
+        state = 0
+        for token in pattern:
+            if token not in goto[state]:
+                goto.append({})
+                output.append(-1)
+                goto[state][token] = len(goto) - 1
+            state = goto[state][token]
+        # 同一終止狀態有多個模式時取最長的，便於截斷
+        if output[state] == -1 or len(patterns[output[state]]) < len(pattern):
+            output[state] = index
+
+    fail = [0] * len(goto)
+    transitions = [[0] * len(alphabet) for _ in goto]
+    queue = deque()
+
+    for token, next_state in goto[0].items():
+        transitions[0][column[token]] = next_state
+        queue.append(next_state)
+
+    while queue:
+        state = queue.popleft()
+        if output[state] == -1:
+            output[state] = output[fail[state]]
+        for token in alphabet:
+            col = column[token]
+            if token in goto[state]:
+                next_state = goto[state][token]
+                fail[next_state] = transitions[fail[state]][col]
+                transitions[state][col] = next_state
+                queue.append(next_state)
+            else:
+                transitions[state][col] = transitions[fail[state]][col]
+
+    return alphabet, output, transitions
+
+
+def build_tables(vocab_path, stop_sequences=None):
+    """預先分詞模板片段和停止序列，返回表內容字典"""
+    vocab, vocab_crc = load_vocab(vocab_path)
+    tokenizer = AppTokenizer(vocab)
+
+    fragments = {name: tokenizer.encode_fragment(text) for name, text in CHAT_TEMPLATE_FRAGMENTS.items()}
+    stops = [(text, tokenizer.encode_fragment(text)) for text in (stop_sequences or DEFAULT_STOP_SEQUENCES)]
+    stops = [(text, ids) for text, ids in stops if ids]
+    alphabet, output, transitions = build_automaton([ids for _, ids in stops])
+
+    return {
+        "vocab_crc32": vocab_crc,
+        "fragments": fragments,
+        "stops": stops,
+        "alphabet": alphabet,
+        "output": output,
+        "transitions": transitions,
+    }
+
+
+def _pack_string(text):
+    data = text.encode('utf-8')
+    return struct.pack("<H", len(data)) + data
+
+
+def _pack_ids(ids):
+    return struct.pack(f"<I{len(ids)}i", len(ids), *ids)
+
+
+def serialize_tables(tables):
+    """
+    序列化為小端二進制格式：
+    magic | u16 version | u16 reserved | u32 vocab_crc32
+    u32 片段數 | (u16 名稱長度, 名稱, u32 id 數, i32 ids) ...
+    u32 停止序列數 | (u16 文本長度, 文本, u32 id 數, i32 ids) ...
+    u32 字母表大小 A | i32[A] 有序 token id
+    u32 狀態數 S | i32[S] 狀態輸出（停止序列索引或 -1）| u32[S*A] 轉移表
+    """
+    parts = [TABLE_MAGIC, struct.pack("<HHI", TABLE_VERSION, 0, tables["vocab_crc32"] & 0xFFFFFFFF)]
+
+    parts.append(struct.pack("<I", len(tables["fragments"])))
+    for name, ids in tables["fragments"].items():
+        parts.append(_pack_string(name) + _pack_ids(ids))
+
+    parts.append(struct.pack("<I", len(tables["stops"])))
+    for text, ids in tables["stops"]:
+        parts.append(_pack_string(text) + _pack_ids(ids))
+
+    alphabet = tables["alphabet"]
+    parts.append(_pack_ids(alphabet))
+
+    output = tables["output"]
+    parts.append(struct.pack(f"<I{len(output)}i", len(output), *output))
+    flat = [next_state for row in tables["transitions"] for next_state in row]
+    parts.append(struct.pack(f"<{len(flat)}I", *flat))
+
+    return b"".join(parts)
+
+
+def write_prompt_tables(vocab_path, output_path=None, stop_sequences=None):
+    """
+    根據詞彙表生成並寫入 token 表，默認寫在詞彙表旁邊
+    打包流程每次寫入新的 vocab.json 後都要調用，否則應用端 CRC 校驗失敗會停用該功能
+    """
+    tables = build_tables(vocab_path, stop_sequences)
+    data = serialize_tables(tables)
+
+    output_path = output_path or os.path.join(os.path.dirname(os.path.abspath(vocab_path)), PROMPT_TABLES_FILE)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+
+    print(f"✅ token 表已保存: {output_path} ({len(data)} 字節)")
+    return output_path, tables
+
+
+def read_tables(data):
+    """解析二進制表（用於驗證和基準測試）"""
+    offset = 0
+
+    def unpack(fmt):
+        nonlocal offset
+        values = struct.unpack_from("<" + fmt, data, offset)
+        offset += struct.calcsize("<" + fmt)
+        return values
+
+    def read_string():
+        (length,) = unpack("H")
+        text = data[offset:offset + length].decode('utf-8')
+        unpack(f"{length}x")
+        return text
+
+    def read_ids():
+        (count,) = unpack("I")
+        return list(unpack(f"{count}i"))
+
+    if data[:4] != TABLE_MAGIC:
+        raise ValueError("不是有效的 prompt_tables.bin")
+    unpack("4x")
+    version, _, vocab_crc = unpack("HHI")
+    if version != TABLE_VERSION:
+        raise ValueError(f"不支持的表版本: {version}")
+
+    (fragment_count,) = unpack("I")
+    fragments = {}
+    for _ in range(fragment_count):
+        name = read_string()
+        fragments[name] = read_ids()
+
+    (stop_count,) = unpack("I")
+    stops = []
+    for _ in range(stop_count):
+        text = read_string()
+        stops.append((text, read_ids()))
+
+    alphabet = read_ids()
+    (state_count,) = unpack("I")
+    output = list(unpack(f"{state_count}i"))
+    flat = unpack(f"{state_count * len(alphabet)}I")
+    transitions = [list(flat[i * len(alphabet):(i + 1) * len(alphabet)]) for i in range(state_count)]
+
+    return {
+        "vocab_crc32": vocab_crc,
+        "fragments": fragments,
+        "stops": stops,
+        "alphabet": alphabet,
+        "output": output,
+        "transitions": transitions,
+    }
+
+
+class StopMatcher:
+    """停止序列匹配器：每個 token 一次字典查找和一次數組索引"""
+
+    def __init__(self, tables):
+        self.column = {token: i for i, token in enumerate(tables["alphabet"])}
+        self.output = tables["output"]
+        self.transitions = tables["transitions"]
+        self.state = 0
+
+    def accept(self, token_id):
+        """輸入一個 token，返回完成匹配的停止序列索引，未匹配返回 -1"""
+        col = self.column.get(token_id)
+        self.state = 0 if col is None else self.transitions[self.state][col]
+        return self.output[self.state]
+
+
+def _benchmark_turns(tokenizer, tables, num_turns, rng):
+    """模擬多輪對話，比較每輪全量重新分詞與拼接緩存 id 的耗時"""
+    words = [word for word in tokenizer.vocab if not word.startswith("<")] or ["hello", "world"]
+    messages = [" ".join(rng.choice(words) for _ in range(rng.randint(8, 40))) for _ in range(2 * num_turns)]
+    fragments = tables["fragments"]
+
+    full_time = 0.0
+    cached_time = 0.0
+    full_tokens = 0
+    conversation_text = CHAT_TEMPLATE_FRAGMENTS["bos"]
+    cached_ids = list(fragments["bos"])
+
+    for turn in range(num_turns):
+        user, reply = messages[2 * turn], messages[2 * turn + 1]
+        conversation_text += (
+            CHAT_TEMPLATE_FRAGMENTS["user_turn_start"] + user + CHAT_TEMPLATE_FRAGMENTS["turn_end"]
+            + CHAT_TEMPLATE_FRAGMENTS["model_turn_start"]
+        )
+
+        # 基準：每輪重新分詞整個提示（包含固定模板標記）
+        start = time.perf_counter()
+        prompt_ids = tokenizer.encode_fragment(conversation_text)
+        full_time += time.perf_counter() - start
+        full_tokens += len(prompt_ids)
+
+        # 緩存：只分詞新消息，模板片段直接拼接
+        start = time.perf_counter()
+        cached_ids += fragments["user_turn_start"] + tokenizer.encode_text(user)
+        cached_ids += fragments["turn_end"] + fragments["model_turn_start"]
+        cached_time += time.perf_counter() - start
+
+        # 模型回覆在生成時已經是 token id，直接追加
+        reply_ids = tokenizer.encode_text(reply)
+        cached_ids += reply_ids + fragments["turn_end"]
+        conversation_text += reply + CHAT_TEMPLATE_FRAGMENTS["turn_end"]
+
+    return full_time, cached_time, full_tokens
+
+
+def _benchmark_stop_detection(tokenizer, tables, num_tokens, rng):
+    """比較每個 token 解碼後做字符串後綴檢查與自動機匹配的耗時"""
+    id_to_token = {token_id: token for token, token_id in tokenizer.vocab.items()}
+    token_ids = list(id_to_token)
+    generated = [rng.choice(token_ids) for _ in range(num_tokens)]
+    stop_texts = [text for text, _ in tables["stops"]]
+
+    start = time.perf_counter()
+    text = ""
+    for token_id in generated:
+        text += id_to_token[token_id]
+        any(text.endswith(stop) for stop in stop_texts)
+    string_time = time.perf_counter() - start
+
+    matcher = StopMatcher(tables)
+    start = time.perf_counter()
+    for token_id in generated:
+        matcher.accept(token_id)
+    automaton_time = time.perf_counter() - start
+
+    return string_time, automaton_time
+
+
+def benchmark(vocab_path, tables_path, num_turns=20, num_tokens=20000, seed=0):
+    """基準測試：每輪避免的分詞時間和停止檢測耗時"""
+    vocab, vocab_crc = load_vocab(vocab_path)
+    with open(tables_path, 'rb') as f:
+        tables = read_tables(f.read())
+    if tables["vocab_crc32"] != vocab_crc:
+        print("⚠️ token 表與當前詞彙表不一致，請重新生成")
+        return None
+
+    tokenizer = AppTokenizer(vocab)
+    rng = random.Random(seed)
+
+    full_time, cached_time, full_tokens = _benchmark_turns(tokenizer, tables, num_turns, rng)
+    string_time, automaton_time = _benchmark_stop_detection(tokenizer, tables, num_tokens, rng)
+
+    results = {
+        "turns": num_turns,
+        "full_retokenize_us_per_turn": full_time / num_turns * 1e6,
+        "cached_assembly_us_per_turn": cached_time / num_turns * 1e6,
+        "avg_prompt_tokens": full_tokens / num_turns,
+        "string_stop_check_us_per_token": string_time / num_tokens * 1e6,
+        "automaton_stop_check_us_per_token": automaton_time / num_tokens * 1e6,
+    }
+    results["avoided_us_per_turn"] = (
+        results["full_retokenize_us_per_turn"] - results["cached_assembly_us_per_turn"]
+    )
+
+    print(f"\n{num_turns} 輪對話（平均提示 {results['avg_prompt_tokens']:.0f} tokens）:")
+    print(f"  全量重新分詞: {results['full_retokenize_us_per_turn']:.1f} µs/輪")
+    print(f"  拼接緩存 id:  {results['cached_assembly_us_per_turn']:.1f} µs/輪")
+    print(f"  每輪節省:     {results['avoided_us_per_turn']:.1f} µs")
+    print("停止檢測:")
+    print(f"  字符串後綴檢查: {results['string_stop_check_us_per_token']:.2f} µs/token")
+    print(f"  Aho-Corasick:   {results['automaton_stop_check_us_per_token']:.2f} µs/token")
+
+    return results
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="生成聊天模板和停止序列的預分詞 token 表")
+    parser.add_argument("--vocab", default="../app/src/main/assets/vocab.json", help="應用內置詞彙表")
+    parser.add_argument("--output", default=f"../app/src/main/assets/{PROMPT_TABLES_FILE}", help="輸出路徑")
+    parser.add_argument("--stop", nargs="+", default=DEFAULT_STOP_SEQUENCES, help="停止序列")
+    parser.add_argument("--benchmark", action="store_true", help="生成後運行基準測試")
+    parser.add_argument("--turns", type=int, default=20, help="基準測試的對話輪數")
+    args = parser.parse_args()
+
+    _, tables = write_prompt_tables(args.vocab, args.output, args.stop)
+    for name, ids in tables["fragments"].items():
+        print(f"   {name}: {ids}")
+    for text, ids in tables["stops"]:
+        print(f"   停止序列 {text!r}: {ids}")
+    print(f"   自動機: {len(tables['output'])} 個狀態, 字母表 {len(tables['alphabet'])} 個 token")
+
+    if args.benchmark:
+        benchmark(args.vocab, args.output, args.turns)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
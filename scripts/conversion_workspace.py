@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+模型轉換工作區
+將轉換拆分為帶磁盤標記的階段，重新運行時從最後完成的階段繼續；
+中間產物放在受管理的臨時區域（可選 tmpfs），不再活動的運行按過期時間或容量預算自動回收
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+DEFAULT_STATE_DIR = "./converted_models/.conversion_state"
+DEFAULT_SCRATCH_DIR = "./converted_models/.scratch"
+TMPFS_SCRATCH_DIR = "/dev/shm/gemma_conversion"
+
+MARKER_SUFFIX = ".done.json"
+# 運行目錄中記錄所屬進程的文件，進程退出後該運行視為不再活動
+OWNER_FILE = ".owner"
+# 不再活動的運行超過該時間未修改即回收（沒有設置容量預算時也適用）
+STALE_RUN_SECONDS = 24 * 3600
+
+WEIGHT_FILE_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".h5")
+
+
+def make_run_key(model_name, **params):
+    """根據模型名稱和轉換參數生成運行標識，參數不同的轉換互不干擾"""
+    payload = json.dumps({"model_name": model_name, **params}, sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
+    return f"{model_name.replace('/', '_')}-{digest}"
+
+
+def state_dict_digest(state_dict):
+    """按參數名、形狀、類型和原始字節計算權重摘要（bfloat16 等 numpy 不支持的類型也適用）"""
+    import torch
+
+    digest = hashlib.sha1()
+    for name in sorted(state_dict):
+        tensor = state_dict[name]
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode('utf-8'))
+        data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+        digest.update(data.numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def weight_files_digest(model_dir):
+    """
+    計算目錄下權重文件的摘要，沒有權重文件時返回 None
+    Hugging Face 緩存中的文件是指向 blobs/<sha256> 的符號鏈接，直接使用其內容哈希
+    """
+    digest = hashlib.sha1()
+    found = False
+    for root, _, files in os.walk(model_dir):
+        for name in sorted(files):
+            if not name.endswith(WEIGHT_FILE_SUFFIXES):
+                continue
+            found = True
+            file_path = os.path.join(root, name)
+            real_path = os.path.realpath(file_path)
+            digest.update(os.path.relpath(file_path, model_dir).encode('utf-8'))
+            if os.path.basename(os.path.dirname(real_path)) == "blobs":
+                digest.update(os.path.basename(real_path).encode('utf-8'))
+                continue
+            with open(real_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                    digest.update(chunk)
+
+    return digest.hexdigest()[:16] if found else None
+
+
+def output_fingerprint(path):
+    """產物的大小和修改時間（目錄取全部文件的總大小和最新修改時間），不存在時返回 None"""
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    size = 0
+    mtime_ns = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            size += stat.st_size
+            mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+    return {"size": size, "mtime_ns": mtime_ns}
+
+
+def latest_mtime(path):
+    """目錄中最新文件的修改時間（秒），空目錄取目錄本身"""
+    latest = os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                latest = max(latest, os.path.getmtime(file_path))
+    return latest
+
+
+def is_run_active(run_path):
+    """運行目錄的所屬進程是否仍在運行"""
+    try:
+        with open(os.path.join(run_path, OWNER_FILE), 'r', encoding='utf-8') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def directory_size(path):
+    """目錄總大小（字節）"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+
+class ConversionWorkspace:
+    """
+    轉換階段管理
+    - 階段標記保存在 state_dir，很小且持久，不受臨時區域回收影響
+    - 中間產物保存在 scratch_root/<run_key>/<stage>，階段完成後可釋放
+    - estimated_bytes 為中間產物的估算大小，沒有容量預算時用於檢查 tmpfs 空間
+    """
+
+    def __init__(self, run_key, state_dir=DEFAULT_STATE_DIR, scratch_root=None,
+                 budget_bytes=None, use_tmpfs=False, keep_intermediates=False,
+                 estimated_bytes=None):
+        self.run_key = run_key
+        self.state_dir = os.path.join(state_dir, run_key)
+        self.budget_bytes = budget_bytes
+        self.keep_intermediates = keep_intermediates
+        self.scratch_root = self._choose_scratch_root(scratch_root, use_tmpfs, estimated_bytes)
+        self.run_dir = os.path.join(self.scratch_root, run_key)
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        os.makedirs(self.run_dir, exist_ok=True)
+        with open(os.path.join(self.run_dir, OWNER_FILE), 'w', encoding='utf-8') as f:
+            f.write(str(os.getpid()))
+
+    def _choose_scratch_root(self, scratch_root, use_tmpfs, estimated_bytes):
+        """
+        選擇臨時區域：tmpfs 佔用內存，只有可用空間不小於預算（沒有預算時取估算大小）才使用，
+        兩者都沒有、tmpfs 不可用或空間不足時回退到磁盤
+        """
+        if use_tmpfs:
+            required_bytes = self.budget_bytes if self.budget_bytes is not None else estimated_bytes
+            tmpfs_parent = os.path.dirname(TMPFS_SCRATCH_DIR)
+            if required_bytes is None:
+                print("tmpfs 需要容量預算或中間產物的估算大小，回退到磁盤")
+            elif os.path.isdir(tmpfs_parent):
+                free_bytes = shutil.disk_usage(tmpfs_parent).free
+                if free_bytes >= required_bytes:
+                    print(f"使用 tmpfs 臨時區域: {TMPFS_SCRATCH_DIR}")
+                    return TMPFS_SCRATCH_DIR
+                print(f"tmpfs 可用空間 {free_bytes / 1024 ** 3:.1f}GB 小於所需的 "
+                      f"{required_bytes / 1024 ** 3:.1f}GB，回退到磁盤")
+            else:
+                print("tmpfs 不可用，回退到磁盤")
+
+        return scratch_root or DEFAULT_SCRATCH_DIR
+
+    def _marker_path(self, stage):
+        return os.path.join(self.state_dir, stage + MARKER_SUFFIX)
+
+    def stage_dir(self, stage):
+        """階段的中間產物目錄"""
+        path = os.path.join(self.run_dir, stage)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def load_marker(self, stage):
+        """讀取階段標記，不存在時返回 None"""
+        marker_path = self._marker_path(stage)
+        if not os.path.exists(marker_path):
+            return None
+
+        with open(marker_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def is_done(self, stage):
+        """
+        階段已完成且其輸出仍是當時寫入的文件
+        輸出路徑固定時，另一次運行可能在同一位置寫入了別的產物，因此比較大小和修改時間
+        """
+        marker = self.load_marker(stage)
+        if marker is None:
+            return False
+
+        fingerprints = marker.get("fingerprints", {})
+        for name, path in marker["outputs"].items():
+            if not path:
+                continue
+            recorded = fingerprints.get(name)
+            if recorded is None or output_fingerprint(path) != recorded:
+                return False
+        return True
+
+    def outputs(self, stage):
+        marker = self.load_marker(stage)
+        return marker["outputs"] if marker else None
+
+    def mark_done(self, stage, outputs, elapsed):
+        """寫入階段標記（先寫臨時文件再重命名，避免崩潰留下半個標記）"""
+        marker = {
+            "stage": stage,
+            "outputs": outputs,
+            "fingerprints": {name: output_fingerprint(path) for name, path in outputs.items() if path},
+            "elapsed_sec": round(elapsed, 1),
+            "completed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self._write_marker(stage, marker)
+
+    def refresh(self, stage):
+        """後續階段原地改寫了本階段的輸出時，重新記錄輸出指紋"""
+        marker = self.load_marker(stage)
+        if marker is None:
+            return
+
+        marker["fingerprints"] = {
+            name: output_fingerprint(path) for name, path in marker["outputs"].items() if path
+        }
+        self._write_marker(stage, marker)
+
+    def _write_marker(self, stage, marker):
+        marker_path = self._marker_path(stage)
+        tmp_path = marker_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(marker, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, marker_path)
+
+    def invalidate(self, stage):
+        """刪除階段標記和中間產物，強制重新運行"""
+        marker_path = self._marker_path(stage)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        shutil.rmtree(os.path.join(self.run_dir, stage), ignore_errors=True)
+
+    def run_stage(self, stage, fn):
+        """
+        運行階段：已完成則直接返回記錄的輸出，否則調用 fn(stage_dir) 並寫入標記
+        fn 返回 {名稱: 路徑} 字典；上游階段可在 fn 內部按需調用 run_stage
+        """
+        if self.is_done(stage):
+            print(f"⏭️ 階段 {stage} 已完成，跳過")
+            return self.outputs(stage)
+
+        # 上次中斷留下的不完整產物
+        shutil.rmtree(os.path.join(self.run_dir, stage), ignore_errors=True)
+        self.collect_garbage()
+
+        print(f"▶️ 運行階段: {stage}")
+        start = time.time()
+        outputs = fn(self.stage_dir(stage))
+        elapsed = time.time() - start
+        self.mark_done(stage, outputs, elapsed)
+        print(f"✅ 階段 {stage} 完成 ({elapsed:.0f}s)")
+
+        self.check_budget()
+        return outputs
+
+    def release(self, stage):
+        """下游階段完成後釋放中間產物，標記保留以記錄歷史"""
+        if self.keep_intermediates:
+            return
+
+        stage_path = os.path.join(self.run_dir, stage)
+        if os.path.isdir(stage_path):
+            freed = directory_size(stage_path)
+            shutil.rmtree(stage_path, ignore_errors=True)
+            print(f"🧹 已釋放 {stage} 中間產物 ({freed / 1024 ** 3:.2f}GB)")
+
+    def usage(self):
+        """臨時區域當前佔用（字節）"""
+        if not os.path.isdir(self.scratch_root):
+            return 0
+        return directory_size(self.scratch_root)
+
+    def check_budget(self):
+        """超出預算時先回收其他運行，仍超出則給出警告"""
+        if self.budget_bytes is None:
+            return
+
+        if self.usage() > self.budget_bytes:
+            self.collect_garbage()
+
+        usage = self.usage()
+        if usage > self.budget_bytes:
+            print(f"⚠️ 臨時區域佔用 {usage / 1024 ** 3:.1f}GB 超出預算 {self.budget_bytes / 1024 ** 3:.1f}GB")
+
+    def collect_garbage(self):
+        """
+        回收其他不再活動的運行（所屬進程已退出）的中間產物，按最近修改時間從舊到新：
+        超過 STALE_RUN_SECONDS 未修改的總是刪除，設置了預算時繼續刪除直到回到預算內
+        """
+        if not os.path.isdir(self.scratch_root):
+            return
+
+        other_runs = []
+        for name in os.listdir(self.scratch_root):
+            run_path = os.path.join(self.scratch_root, name)
+            if name == self.run_key or not os.path.isdir(run_path) or is_run_active(run_path):
+                continue
+            other_runs.append((latest_mtime(run_path), run_path))
+        other_runs.sort()
+
+        now = time.time()
+        for mtime, run_path in other_runs:
+            stale = now - mtime > STALE_RUN_SECONDS
+            over_budget = self.budget_bytes is not None and self.usage() > self.budget_bytes
+            if not stale and not over_budget:
+                break
+            shutil.rmtree(run_path, ignore_errors=True)
+            print(f"🧹 已回收舊的中間產物: {run_path}")
+
+    def finish(self):
+        """轉換完成後刪除本次運行的全部中間產物；保留時只解除進程佔用，之後可按過期時間回收"""
+        if self.keep_intermediates:
+            owner_path = os.path.join(self.run_dir, OWNER_FILE)
+            if os.path.exists(owner_path):
+                os.remove(owner_path)
+            return
+
+        shutil.rmtree(self.run_dir, ignore_errors=True)
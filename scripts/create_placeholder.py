@@ -8,6 +8,8 @@ import os
 import json
 from pathlib import Path
 
+from build_prompt_tables import write_prompt_tables
+
 def create_placeholder_model():
     """創建佔位符模型文件"""
     models_dir = Path("../app/src/main/assets/models")
@@ -137,6 +139,8 @@ def create_enhanced_vocab():
     
     print(f"✅ 增強詞彙表已創建: {vocab_file}")
     print(f"   詞彙表大小: {len(vocab)} 個詞彙")
+    
+    write_prompt_tables(str(vocab_file))
     return vocab_file
 
 def create_model_info():
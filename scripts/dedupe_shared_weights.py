@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+共享權重檢測和去重腳本
+Gemma 的輸入嵌入和 LM head 是綁定的，但導出時常被序列化兩次。
+本腳本檢測 PyTorch state dict 和 TFLite flatbuffer 中相同（或轉置後相同）的權重張量，
+讓它們共享同一個緩衝區，並報告節省的字節數以及加載時間和常駐內存的變化
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+from collections import defaultdict
+
+DEDUPE_REPORT_FILE = "dedupe_report.json"
+
+# TFLite schema 中 TensorType 到 numpy dtype 的映射
+TFLITE_TENSOR_DTYPES = {
+    0: "float32",
+    1: "float16",
+    2: "int32",
+    3: "uint8",
+    4: "int64",
+    7: "int16",
+    9: "int8",
+}
+
+
+def _tensor_digest(tensor):
+    """按原始字節計算張量摘要（bfloat16 等 numpy 不支持的類型也適用）"""
+    import torch
+
+    data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+    return hashlib.sha1(data.numpy().tobytes()).hexdigest()
+
+
+def _tensor_nbytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def analyze_state_dict(state_dict):
+    """
+    分析 state dict 中的共享權重，返回分組列表：
+    - shared_storage: 已經共享存儲（已綁定）
+    - identical: 內容相同但存儲獨立，可以綁定
+    - transposed: 轉置後相同，只報告
+    """
+    groups = []
+
+    by_storage = defaultdict(list)
+    for name, tensor in state_dict.items():
+        by_storage[(tensor.data_ptr(), tuple(tensor.shape), str(tensor.dtype))].append(name)
+
+    # 每個存儲只取一個代表參與內容比較
+    by_content = defaultdict(list)
+    transposed = {}
+    for names in by_storage.values():
+        if len(names) > 1:
+            groups.append({"kind": "shared_storage", "tensors": names, "bytes_saved": 0})
+
+        tensor = state_dict[names[0]]
+        by_content[(tuple(tensor.shape), str(tensor.dtype), _tensor_digest(tensor))].append(names[0])
+        if tensor.dim() == 2:
+            transposed[names[0]] = (tuple(tensor.t().shape), str(tensor.dtype), _tensor_digest(tensor.t()))
+
+    for names in by_content.values():
+        if len(names) > 1:
+            groups.append({
+                "kind": "identical",
+                "tensors": names,
+                "bytes_saved": _tensor_nbytes(state_dict[names[0]]) * (len(names) - 1),
+            })
+
+    reported = set()
+    for name, key in transposed.items():
+        for partner in by_content.get(key, []):
+            pair = tuple(sorted((name, partner)))
+            if partner != name and pair not in reported:
+                reported.add(pair)
+                groups.append({
+                    "kind": "transposed",
+                    "tensors": list(pair),
+                    "bytes_saved": _tensor_nbytes(state_dict[name]),
+                })
+
+    return groups
+
+
+def tie_duplicate_parameters(model, groups):
+    """讓內容相同的參數共享同一個 Parameter 對象，返回節省的字節數"""
+    bytes_saved = 0
+    parameters = dict(model.named_parameters(remove_duplicate=False))
+
+    for group in groups:
+        if group["kind"] != "identical":
+            continue
+
+        # buffer 等非參數張量保持不變
+        names = [name for name in group["tensors"] if name in parameters]
+        if len(names) < 2:
+            continue
+
+        canonical = parameters[names[0]]
+        for name in names[1:]:
+            module_name, _, attr = name.rpartition(".")
+            module = model.get_submodule(module_name) if module_name else model
+            setattr(module, attr, canonical)
+            bytes_saved += _tensor_nbytes(canonical)
+
+    return bytes_saved
+
+
+def _buffer_array(model_t, tensor):
+    """返回張量常量數據的 numpy 數組（按形狀），沒有常量數據時返回 None"""
+    import numpy as np
+
+    buffer = model_t.buffers[tensor.buffer]
+    dtype = TFLITE_TENSOR_DTYPES.get(tensor.type)
+    if buffer.data is None or dtype is None or tensor.shape is None:
+        return None
+
+    array = np.frombuffer(np.asarray(buffer.data, dtype=np.uint8).tobytes(), dtype=dtype)
+    if array.size != int(np.prod(tensor.shape)):
+        return None
+    return array.reshape(tensor.shape)
+
+
+def analyze_tflite_buffers(model_t):
+    """
+    分析 flatbuffer 中的重複緩衝區
+    返回 (重複緩衝區映射 {重複索引: 保留索引}, 報告分組列表)
+    """
+    import numpy as np
+
+    by_content = {}
+    duplicates = {}
+    groups = []
+
+    # 變量張量在運行時會被寫入，不能共享
+    variable_buffers = {
+        tensor.buffer
+        for subgraph in model_t.subgraphs
+        for tensor in subgraph.tensors
+        if tensor.isVariable
+    }
+
+    for index, buffer in enumerate(model_t.buffers):
+        if buffer.data is None or len(buffer.data) == 0 or index in variable_buffers:
+            continue
+
+        key = hashlib.sha1(np.asarray(buffer.data, dtype=np.uint8).tobytes()).hexdigest()
+        if key in by_content:
+            duplicates[index] = by_content[key]
+        else:
+            by_content[key] = index
+
+    canonical_groups = defaultdict(list)
+    for duplicate, canonical in duplicates.items():
+        canonical_groups[canonical].append(duplicate)
+    for canonical, dups in canonical_groups.items():
+        groups.append({
+            "kind": "identical",
+            "buffers": [canonical] + dups,
+            "bytes_saved": len(model_t.buffers[canonical].data) * len(dups),
+        })
+
+    # 轉置後相同的二維常量：共享需要插入 TRANSPOSE 算子，只報告
+    matrices = {}
+    for subgraph in model_t.subgraphs:
+        for tensor in subgraph.tensors:
+            if tensor.shape is not None and len(tensor.shape) == 2 and tensor.buffer not in duplicates:
+                array = _buffer_array(model_t, tensor)
+                if array is not None:
+                    matrices[tensor.buffer] = (tensor.type, array)
+
+    by_matrix = {
+        (tensor_type, array.shape, hashlib.sha1(array.tobytes()).hexdigest()): index
+        for index, (tensor_type, array) in matrices.items()
+    }
+    reported = set()
+    for index, (tensor_type, array) in matrices.items():
+        transposed = np.ascontiguousarray(array.T)
+        partner = by_matrix.get((tensor_type, transposed.shape, hashlib.sha1(transposed.tobytes()).hexdigest()))
+        pair = tuple(sorted((index, partner))) if partner is not None else None
+        if pair and partner != index and pair not in reported:
+            reported.add(pair)
+            groups.append({"kind": "transposed", "buffers": list(pair), "bytes_saved": array.nbytes})
+
+    return duplicates, groups
+
+
+def external_buffer_count(tflite_path):
+    """
+    統計權重存放在 flatbuffer 之外的緩衝區數量（buffer.offset > 1）
+    超過 2GB 的模型由轉換器把權重追加在 flatbuffer 之後，flatbuffer_utils.write_model 不會寫回這些數據
+    """
+    from tensorflow.lite.python import schema_py_generated as schema_fb
+
+    with open(tflite_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        model = schema_fb.Model.GetRootAsModel(data, 0)
+        count = 0
+        for index in range(model.BuffersLength()):
+            buffer = model.Buffers(index)
+            if hasattr(buffer, "Offset") and buffer.Offset() > 1:
+                count += 1
+        return count
+
+
+def dedupe_tflite(input_path, output_path=None):
+    """讓 flatbuffer 中內容相同的常量張量共享同一個緩衝區，返回報告"""
+    from tensorflow.lite.tools import flatbuffer_utils
+
+    output_path = output_path or input_path
+    size_before = os.path.getsize(input_path)
+
+    external_buffers = external_buffer_count(input_path)
+    if external_buffers:
+        # 改寫會丟失外部權重，保持文件不變
+        print(f"⚠️ {input_path} 有 {external_buffers} 個外部存儲的緩衝區，跳過去重")
+        if output_path != input_path:
+            shutil.copy2(input_path, output_path)
+        return {
+            "input": input_path,
+            "output": output_path,
+            "size_before": size_before,
+            "size_after": size_before,
+            "shared_buffers": 0,
+            "groups": [],
+            "skipped": f"{external_buffers} external buffers",
+        }
+
+    model_t = flatbuffer_utils.read_model(input_path)
+    duplicates, groups = analyze_tflite_buffers(model_t)
+
+    for subgraph in model_t.subgraphs:
+        for tensor in subgraph.tensors:
+            if tensor.buffer in duplicates:
+                tensor.buffer = duplicates[tensor.buffer]
+
+    # 保留空緩衝區佔位，避免重新編號其他索引
+    for index in duplicates:
+        model_t.buffers[index].data = None
+
+    tmp_path = output_path + ".tmp"
+    flatbuffer_utils.write_model(model_t, tmp_path)
+    shutil.move(tmp_path, output_path)
+
+    return {
+        "input": input_path,
+        "output": output_path,
+        "size_before": size_before,
+        "size_after": os.path.getsize(output_path),
+        "shared_buffers": len(duplicates),
+        "groups": groups,
+    }
+
+
+def _current_rss_bytes():
+    """當前進程常駐內存（Linux 讀 /proc，其他平台用峰值近似）"""
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    import resource
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _measure_in_process(model_path):
+    """在當前進程加載解釋器並測量加載時間和 RSS 增量"""
+    import tensorflow as tf
+
+    rss_before = _current_rss_bytes()
+    start = time.perf_counter()
+    interpreter = tf.lite.Interpreter(model_path=model_path)
+    interpreter.allocate_tensors()
+    load_ms = (time.perf_counter() - start) * 1000
+
+    return {"load_ms": load_ms, "rss_delta_bytes": _current_rss_bytes() - rss_before}
+
+
+def measure_interpreter(model_path, runs=3):
+    """在獨立子進程中測量，避免頁緩存和已加載模塊互相干擾，取中位數"""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "--measure-only", model_path],
+            text=True
+        )
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    samples.sort(key=lambda sample: sample["load_ms"])
+    return samples[len(samples) // 2]
+
+
+def dedupe_with_report(tflite_path, output_path=None, report_path=None, measure=True):
+    """去重並寫入報告（包含加載時間和 RSS 對比）"""
+    before = measure_interpreter(tflite_path) if measure else None
+    report = dedupe_tflite(tflite_path, output_path)
+    if measure:
+        report["interpreter_before"] = before
+        report["interpreter_after"] = measure_interpreter(report["output"])
+
+    report_path = report_path or os.path.join(os.path.dirname(report["output"]), DEDUPE_REPORT_FILE)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_report(report)
+    return report
+
+
+def print_report(report):
+    """打印去重報告"""
+    if report.get("skipped"):
+        print(f"\n未去重: {report['skipped']}")
+        return
+
+    saved = report["size_before"] - report["size_after"]
+    print(f"\n共享緩衝區: {report['shared_buffers']} 個")
+    print(f"文件大小: {report['size_before'] / 1024 ** 2:.1f}MB -> {report['size_after'] / 1024 ** 2:.1f}MB "
+          f"(節省 {saved / 1024 ** 2:.1f}MB)")
+
+    transposed = [group for group in report["groups"] if group["kind"] == "transposed"]
+    if transposed:
+        print(f"轉置相同的張量: {len(transposed)} 組（需在導出前綁定，未自動改寫）")
+
+    if report.get("interpreter_before"):
+        before = report["interpreter_before"]
+        after = report["interpreter_after"]
+        print(f"加載時間: {before['load_ms']:.0f}ms -> {after['load_ms']:.0f}ms")
+        print(f"RSS 增量: {before['rss_delta_bytes'] / 1024 ** 2:.1f}MB -> "
+              f"{after['rss_delta_bytes'] / 1024 ** 2:.1f}MB")
+
+
+def analyze_checkpoint(model_name, cache_dir="./models", tie=False):
+    """分析 PyTorch checkpoint 的共享權重"""
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(model_name, cache_dir=cache_dir, torch_dtype="auto")
+    groups = analyze_state_dict(model.state_dict())
+
+    for group in groups:
+        print(f"  [{group['kind']}] {', '.join(group['tensors'])} "
+              f"({group['bytes_saved'] / 1024 ** 2:.1f}MB)")
+
+    if tie:
+        saved = tie_duplicate_parameters(model, groups)
+        print(f"已綁定重複參數，節省 {saved / 1024 ** 2:.1f}MB")
+
+    return model, groups
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="檢測並共享重複的權重張量")
+    parser.add_argument("--tflite", default=None, help="要去重的 TFLite 模型")
+    parser.add_argument("--output", default=None, help="輸出路徑（默認原地改寫）")
+    parser.add_argument("--model", default=None, help="分析該模型 PyTorch state dict 中的共享權重")
+    parser.add_argument("--cache-dir", default="./models", help="模型緩存目錄")
+    parser.add_argument("--no-measure", action="store_true", help="不測量加載時間和 RSS")
+    parser.add_argument("--measure-only", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_only:
+        # 子進程測量模式：輸出一行 JSON
+        print(json.dumps(_measure_in_process(args.measure_only)))
+        return 0
+
+    if args.model:
+        print(f"分析 {args.model} 的 state dict...")
+        analyze_checkpoint(args.model, args.cache_dir)
+
+    if args.tflite:
+        dedupe_with_report(args.tflite, args.output, measure=not args.no_measure)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
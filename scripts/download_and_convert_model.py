@@ -11,6 +11,14 @@ import requests
 from pathlib import Path
 import tempfile
 import shutil
+import argparse
+
+from build_prompt_tables import write_prompt_tables
+from conversion_workspace import ConversionWorkspace, make_run_key, state_dict_digest, weight_files_digest
+from estimate_model_resources import count_parameters
+from dedupe_shared_weights import (
+    DEDUPE_REPORT_FILE, analyze_state_dict, dedupe_with_report, external_buffer_count, tie_duplicate_parameters
+)
 
 def check_dependencies():
     """檢查必要的依賴"""
@@ -69,87 +77,251 @@ def download_gemma_model(model_name="google/gemma-2b", cache_dir="./models"):
         print(f"模型下載失敗: {e}")
         return None, None, None
 
-def convert_to_tflite(model, tokenizer, output_dir="./converted_models"):
-    """將模型轉換為 TensorFlow Lite 格式"""
+def add_workspace_arguments(parser):
+    """中間產物相關的命令行參數（轉換、草稿模型導出和剪枝腳本共用）"""
+    parser.add_argument("--scratch-dir", default=None, help="中間產物目錄（默認在輸出目錄下）")
+    parser.add_argument("--scratch-budget-gb", type=float, default=None, help="中間產物容量預算（GB）")
+    parser.add_argument("--tmpfs", action="store_true", help="中間產物優先放在 tmpfs")
+    parser.add_argument("--keep-intermediates", action="store_true", help="轉換完成後保留中間產物")
+
+def workspace_options(args):
+    """從命令行參數中取出 create_workspace 的中間產物選項"""
+    return {
+        "scratch_dir": args.scratch_dir,
+        "budget_gb": args.scratch_budget_gb,
+        "use_tmpfs": args.tmpfs,
+        "keep_intermediates": args.keep_intermediates,
+    }
+
+def estimate_scratch_bytes(config):
+    """按配置估算中間產物大小（float32 SavedModel），配置不完整時返回 None"""
+    config_dict = config.to_dict() if hasattr(config, "to_dict") else config
+    try:
+        params = count_parameters(config_dict.get("text_config") or config_dict)
+    except (KeyError, TypeError):
+        return None
+    return params["total"] * 4
+
+def create_workspace(model_name_or_path, config, output_dir="./converted_models", weights_digest=None,
+                     scratch_dir=None, budget_gb=None, use_tmpfs=False, keep_intermediates=False,
+                     estimated_bytes=None):
+    """
+    創建轉換工作區，運行標識包含模型配置和權重摘要
+    配置相同但權重不同（例如不同校準語料剪枝出的檔位）時不會誤用舊的階段結果
+    """
+    run_key = make_run_key(
+        model_name_or_path,
+        config=config.to_json_string() if hasattr(config, "to_json_string") else config,
+        weights=weights_digest,
+        output_dir=os.path.abspath(output_dir)
+    )
+    return ConversionWorkspace(
+        run_key,
+        state_dir=os.path.join(output_dir, ".conversion_state"),
+        scratch_root=scratch_dir,
+        budget_bytes=int(budget_gb * 1024 ** 3) if budget_gb else None,
+        use_tmpfs=use_tmpfs,
+        keep_intermediates=keep_intermediates,
+        estimated_bytes=estimated_bytes if estimated_bytes is not None else estimate_scratch_bytes(config)
+    )
+
+def create_workspace_for_model(model, output_dir, **options):
+    """為已加載的模型創建工作區，權重摘要和中間產物大小直接按內存中的參數計算"""
+    return create_workspace(
+        model.config.name_or_path, model.config, output_dir,
+        weights_digest=state_dict_digest(model.state_dict()),
+        estimated_bytes=sum(p.numel() for p in model.parameters()) * 4,
+        **options
+    )
+
+def model_files_digest(model_name_or_path, cache_dir="./models"):
+    """本地目錄或 Hugging Face 緩存中模型權重文件的摘要，模型尚未下載時返回 None"""
+    if os.path.isdir(model_name_or_path):
+        return weight_files_digest(model_name_or_path)
+
+    try:
+        from huggingface_hub import snapshot_download
+        
+        snapshot_dir = snapshot_download(model_name_or_path, cache_dir=cache_dir, local_files_only=True)
+    except Exception:
+        return None
+    return weight_files_digest(snapshot_dir)
+
+def is_conversion_complete(workspace):
+    """檢查轉換是否已完成（任一轉換路徑的產物和詞彙表都已存在）"""
+    return (
+        (workspace.is_done("tflite") or workspace.is_done("optimum_tflite"))
+        and workspace.is_done("vocab")
+    )
+
+def save_vocabulary_stage(tokenizer, output_dir, workspace):
+    """保存分詞器詞彙表（階段: vocab）"""
+    def save_vocab(stage_dir):
+        saved_files = tokenizer.save_vocabulary(output_dir)
+        return {f"file_{i}": path for i, path in enumerate(saved_files)}
+
+    workspace.run_stage("vocab", save_vocab)
+    return os.path.join(output_dir, "vocab.json")
+
+def dedupe_buffers_stage(tflite_path, output_dir, workspace, source_stage):
+    """讓 flatbuffer 中重複的權重共享緩衝區（階段: dedupe_buffers）"""
+    if external_buffer_count(tflite_path):
+        # 超過 2GB 的模型權重存放在 flatbuffer 之外，改寫會丟失這些權重
+        print("⚠️ 模型包含外部存儲的權重，跳過緩衝區去重")
+        return tflite_path
+    
+    def dedupe(stage_dir):
+        report_path = os.path.join(output_dir, DEDUPE_REPORT_FILE)
+        dedupe_with_report(tflite_path, report_path=report_path, measure=False)
+        # 模型文件被原地改寫，更新上游階段記錄的指紋
+        workspace.refresh(source_stage)
+        return {"tflite": tflite_path, "report": report_path}
+
+    workspace.run_stage("dedupe_buffers", dedupe)
+    return tflite_path
+
+def tie_shared_weights(model):
+    """導出前綁定 state dict 中內容相同的參數（例如未綁定的嵌入和 LM head）"""
+    groups = analyze_state_dict(model.state_dict())
+    bytes_saved = tie_duplicate_parameters(model, groups)
+    if bytes_saved:
+        print(f"已綁定重複權重，節省 {bytes_saved / 1024 / 1024:.1f} MB")
+
+def _write_atomic(path, data):
+    """先寫臨時文件再重命名，中斷時不會留下半個模型文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def convert_to_tflite(model, tokenizer, output_dir="./converted_models", workspace=None):
+    """
+    將模型轉換為 TensorFlow Lite 格式
+    分為 saved_model -> tflite -> dedupe_buffers -> vocab 階段，重新運行時從最後完成的階段繼續
+    """
     print("開始轉換模型為 TensorFlow Lite 格式...")
     
+    # 創建輸出目錄
+    os.makedirs(output_dir, exist_ok=True)
+    
+    if workspace is None:
+        workspace = create_workspace_for_model(model, output_dir)
+    
+    # 之前已經通過 Optimum 轉換成功
+    if workspace.is_done("optimum_tflite"):
+        return convert_with_optimum(model, tokenizer, output_dir, workspace)
+    
     try:
         import tensorflow as tf
         from transformers import TFAutoModelForCausalLM
         
-        # 創建輸出目錄
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # 轉換為 TensorFlow 格式
-        print("轉換為 TensorFlow 格式...")
-        tf_model = TFAutoModelForCausalLM.from_pretrained(
-            model.config.name_or_path,
-            from_tf=False,
-            from_pytorch=True
-        )
-        
-        # 保存 TensorFlow 模型
-        tf_model_path = os.path.join(output_dir, "tf_model")
-        tf_model.save_pretrained(tf_model_path, saved_model=True)
+        def export_saved_model(stage_dir):
+            # 轉換為 TensorFlow 格式
+            print("轉換為 TensorFlow 格式...")
+            tf_model = TFAutoModelForCausalLM.from_pretrained(
+                model.config.name_or_path,
+                from_tf=False,
+                from_pytorch=True
+            )
+            
+            # 保存 TensorFlow 模型（中間產物，放在臨時區域）
+            tf_model.save_pretrained(stage_dir, saved_model=True)
+            return {"saved_model": os.path.join(stage_dir, "saved_model", "1")}
         
-        # 轉換為 TFLite
-        print("轉換為 TensorFlow Lite 格式...")
-        converter = tf.lite.TFLiteConverter.from_saved_model(tf_model_path)
+        def convert_saved_model(stage_dir):
+            tf_model_path = workspace.run_stage("saved_model", export_saved_model)["saved_model"]
+            
+            # 轉換為 TFLite
+            print("轉換為 TensorFlow Lite 格式...")
+            converter = tf.lite.TFLiteConverter.from_saved_model(tf_model_path)
+            
+            # 應用量化
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.int8]
+            
+            # 轉換
+            tflite_model = converter.convert()
+            
+            # 保存 TFLite 模型
+            tflite_path = os.path.join(output_dir, "gemma_3n_2b_int8.tflite")
+            _write_atomic(tflite_path, tflite_model)
+            return {"tflite": tflite_path}
         
-        # 應用量化
-        converter.optimizations = [tf.lite.Optimize.DEFAULT]
-        converter.target_spec.supported_types = [tf.int8]
+        tflite_path = workspace.run_stage("tflite", convert_saved_model)["tflite"]
         
-        # 轉換
-        tflite_model = converter.convert()
-        
-        # 保存 TFLite 模型
-        tflite_path = os.path.join(output_dir, "gemma_3n_2b_int8.tflite")
-        with open(tflite_path, 'wb') as f:
-            f.write(tflite_model)
+    except Exception as e:
+        print(f"模型轉換失敗: {e}")
+        print("已完成的階段會保留，重新運行時從中斷處繼續")
+        print("嘗試使用替代方法...")
+        return convert_with_optimum(model, tokenizer, output_dir, workspace)
+    
+    # 以下階段失敗時不回退到 Optimum，否則會重新導出並覆蓋已完成的 tflite 產物
+    try:
+        workspace.release("saved_model")
+        tflite_path = dedupe_buffers_stage(tflite_path, output_dir, workspace, "tflite")
         
         print(f"TFLite 模型已保存到: {tflite_path}")
         
         # 保存分詞器詞彙表
-        vocab_path = os.path.join(output_dir, "vocab.json")
-        tokenizer.save_vocabulary(output_dir)
+        vocab_path = save_vocabulary_stage(tokenizer, output_dir, workspace)
         
         print(f"詞彙表已保存到: {vocab_path}")
         
-        return tflite_path, vocab_path
-        
     except Exception as e:
-        print(f"模型轉換失敗: {e}")
-        print("嘗試使用替代方法...")
-        return convert_with_optimum(model, tokenizer, output_dir)
+        print(f"轉換後處理失敗: {e}")
+        print("已完成的階段會保留，重新運行時從中斷處繼續")
+        return None, None
+    
+    workspace.finish()
+    return tflite_path, vocab_path
 
-def convert_with_optimum(model, tokenizer, output_dir):
-    """使用 Optimum 進行轉換"""
+def convert_with_optimum(model, tokenizer, output_dir, workspace=None):
+    """使用 Optimum 進行轉換（階段: optimum_tflite）"""
     try:
-        from optimum.tflite import TFLiteConfig, export_tflite
+        if workspace is None:
+            workspace = create_workspace_for_model(model, output_dir)
         
-        print("使用 Optimum 進行轉換...")
+        def export_with_optimum(stage_dir):
+            from optimum.tflite import TFLiteConfig, export_tflite
+            
+            print("使用 Optimum 進行轉換...")
+            
+            tie_shared_weights(model)
+            
+            # 配置量化
+            config = TFLiteConfig(quantization_approach="static")
+            
+            # 轉換到臨時區域，成功後再移動到輸出目錄
+            staged_path = os.path.join(stage_dir, "gemma_3n_2b_int8.tflite")
+            export_tflite(
+                model=model,
+                config=config,
+                output=staged_path
+            )
+            
+            tflite_path = os.path.join(output_dir, "gemma_3n_2b_int8.tflite")
+            shutil.move(staged_path, tflite_path)
+            return {"tflite": tflite_path}
         
-        # 配置量化
-        config = TFLiteConfig(quantization_approach="static")
+        tflite_path = workspace.run_stage("optimum_tflite", export_with_optimum)["tflite"]
         
-        # 轉換
-        tflite_path = os.path.join(output_dir, "gemma_3n_2b_int8.tflite")
-        export_tflite(
-            model=model,
-            config=config,
-            output=tflite_path
-        )
+    except Exception as e:
+        print(f"Optimum 轉換也失敗: {e}")
+        return None, None
+    
+    try:
+        tflite_path = dedupe_buffers_stage(tflite_path, output_dir, workspace, "optimum_tflite")
         
         # 保存詞彙表
-        vocab_path = os.path.join(output_dir, "vocab.json")
-        tokenizer.save_vocabulary(output_dir)
-        
-        return tflite_path, vocab_path
+        vocab_path = save_vocabulary_stage(tokenizer, output_dir, workspace)
         
     except Exception as e:
-        print(f"Optimum 轉換也失敗: {e}")
+        print(f"轉換後處理失敗: {e}")
+        print("已完成的階段會保留，重新運行時從中斷處繼續")
         return None, None
+    
+    workspace.finish()
+    return tflite_path, vocab_path
 
 def copy_to_android_assets(tflite_path, vocab_path, android_project_root):
     """將轉換後的文件複製到 Android 項目"""
@@ -171,6 +343,8 @@ def copy_to_android_assets(tflite_path, vocab_path, android_project_root):
             dest_vocab = os.path.join(assets_dir, "vocab.json")
             shutil.copy2(vocab_path, dest_vocab)
             print(f"詞彙表已複製到: {dest_vocab}")
+            
+            write_prompt_tables(dest_vocab)
         
         return True
         
@@ -200,12 +374,43 @@ def create_placeholder_files(android_project_root):
     vocab_file = os.path.join(assets_dir, "vocab.json")
     with open(vocab_file, 'w', encoding='utf-8') as f:
         json.dump(vocab, f, ensure_ascii=False, indent=2)
+    write_prompt_tables(vocab_file)
     
     print("已創建佔位符文件，應用可以正常編譯和運行")
     print("請稍後替換為真實的模型文件")
 
+def parse_args():
+    """解析命令行參數（交互式問題保持不變）"""
+    parser = argparse.ArgumentParser(description="Gemma 3N 模型下載和轉換工具")
+    parser.add_argument("--model", default="google/gemma-2b", help="模型名稱")
+    parser.add_argument("--cache-dir", default="./models", help="模型緩存目錄")
+    parser.add_argument("--output-dir", default="./converted_models", help="轉換輸出目錄")
+    add_workspace_arguments(parser)
+    return parser.parse_args()
+
+def load_workspace(args):
+    """只讀取模型配置和權重文件摘要（不加載權重）創建工作區，模型未下載時返回 None"""
+    weights_digest = model_files_digest(args.model, args.cache_dir)
+    if weights_digest is None:
+        return None
+    
+    try:
+        from transformers import AutoConfig
+        
+        config = AutoConfig.from_pretrained(args.model, cache_dir=args.cache_dir, trust_remote_code=True)
+        return create_workspace(
+            args.model, config, args.output_dir,
+            weights_digest=weights_digest,
+            **workspace_options(args)
+        )
+    except Exception as e:
+        print(f"無法讀取模型配置，稍後在轉換時創建工作區: {e}")
+        return None
+
 def main():
     """主函數"""
+    args = parse_args()
+    
     print("Gemma 3N 模型下載和轉換工具")
     print("=" * 50)
     
@@ -222,16 +427,31 @@ def main():
     download_real = input("是否下載真實的 Gemma 模型? (需要 HF 訪問權限) [y/N]: ").strip().lower()
     
     if download_real == 'y':
-        # 下載模型
-        model, tokenizer, cache_dir = download_gemma_model()
+        workspace = load_workspace(args)
         
-        if model is None:
-            print("模型下載失敗，創建佔位符文件...")
-            create_placeholder_files(android_project_root)
-            return
-        
-        # 轉換模型
-        tflite_path, vocab_path = convert_to_tflite(model, tokenizer)
+        if workspace is not None and is_conversion_complete(workspace):
+            # 上次已轉換完成，無需重新加載模型
+            print("檢測到已完成的轉換，跳過下載和轉換")
+            stage = "tflite" if workspace.is_done("tflite") else "optimum_tflite"
+            tflite_path = workspace.outputs(stage)["tflite"]
+            vocab_path = os.path.join(args.output_dir, "vocab.json")
+        else:
+            # 下載模型
+            model, tokenizer, cache_dir = download_gemma_model(args.model, args.cache_dir)
+            
+            if model is None:
+                print("模型下載失敗，創建佔位符文件...")
+                create_placeholder_files(android_project_root)
+                return
+            
+            # 首次運行時模型剛下載完成，此時才能計算權重摘要
+            if workspace is None:
+                workspace = load_workspace(args)
+            if workspace is None:
+                workspace = create_workspace_for_model(model, args.output_dir, **workspace_options(args))
+            
+            # 轉換模型
+            tflite_path, vocab_path = convert_to_tflite(model, tokenizer, args.output_dir, workspace)
         
         if tflite_path is None:
             print("模型轉換失敗，創建佔位符文件...")
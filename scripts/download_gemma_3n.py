@@ -11,6 +11,9 @@ import shutil
 from pathlib import Path
 import subprocess
 
+from build_prompt_tables import write_prompt_tables
+from estimate_model_resources import DEFAULT_CONTEXT_LENGTH, estimate_model, format_bytes
+
 def check_dependencies():
     """检查必要的依赖"""
     print("🔍 检查依赖...")
@@ -95,7 +98,8 @@ def setup_huggingface_auth():
         print(f"❌ 认证设置失败: {e}")
         return False
 
-def list_gemma_3n_models():
+def list_gemma_3n_models(cache_dir="./models_cache", mirror_dir=None,
+                         scheme="int8", context_length=DEFAULT_CONTEXT_LENGTH):
     """列出可用的 Gemma 3N 模型"""
     models = {
         "1": {
@@ -124,6 +128,21 @@ def list_gemma_3n_models():
         }
     }
     
+    # 本地有 config.json 时用估算值替换默认的大小和内存要求
+    for model in models.values():
+        estimates = estimate_model(
+            model["name"], cache_dir, mirror_dir, [scheme], context_length
+        )
+        if estimates is None:
+            continue
+
+        estimate = estimates[scheme]
+        model["size"] = f"{format_bytes(estimate['artifact_bytes'])} ({scheme})"
+        model["ram_requirement"] = (
+            f"{format_bytes(estimate['resident_bytes'])}+ (上下文 {context_length})"
+        )
+        model["estimate"] = estimate
+
     print("\n📋 可用的 Gemma 3N 模型:")
     print("=" * 60)
     for key, model in models.items():
@@ -131,6 +150,8 @@ def list_gemma_3n_models():
         print(f"   描述: {model['description']}")
         print(f"   大小: {model['size']}")
         print(f"   内存要求: {model['ram_requirement']}")
+        if model.get("estimate", {}).get("tokens_per_sec"):
+            print(f"   预计速度: {model['estimate']['tokens_per_sec']:.1f} tokens/s")
         print()
     
     return models
@@ -202,6 +223,8 @@ def convert_to_tflite(model, tokenizer, model_name, output_dir="../app/src/main/
         print(f"✅ 词汇表已保存: {vocab_file}")
         print(f"   词汇表大小: {len(vocab_dict)} 个词汇")
         
+        write_prompt_tables(vocab_file)
+        
         # 创建模型信息文件
         model_info = {
             "model_name": model_name,
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Gemma 3N 模型资源估算工具
+只读取 config.json（本地镜像或缓存目录），不下载权重，
+按量化方案估算参数量、产物大小、转换峰值内存、设备端常驻内存和解码速度
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+# 每种量化方案的权重字节数 / KV cache 字节数
+# int8 / int4 为 TFLite 动态范围量化，激活与 KV cache 仍为 float32
+QUANTIZATION_SCHEMES = {
+    "fp32": {"weight_bytes": 4.0, "kv_bytes": 4},
+    "fp16": {"weight_bytes": 2.0, "kv_bytes": 2},
+    "int8": {"weight_bytes": 1.0, "kv_bytes": 4},
+    "int4": {"weight_bytes": 0.5, "kv_bytes": 4},
+}
+
+# 源 checkpoint 的 torch_dtype 对应的字节数
+SOURCE_DTYPE_BYTES = {
+    "float32": 4,
+    "float16": 2,
+    "bfloat16": 2,
+}
+
+# 量化 scale / flatbuffer 元数据的额外开销比例
+ARTIFACT_OVERHEAD_RATIO = 0.02
+# TFLite 解释器自身及 arena 的固定开销
+RUNTIME_OVERHEAD_BYTES = 64 * 1024 * 1024
+# Python / TensorFlow 进程本身在转换时的固定开销
+CONVERSION_OVERHEAD_BYTES = 2 * 1024 * 1024 * 1024
+
+DEFAULT_CONTEXT_LENGTH = 2048
+DEFAULT_CALIBRATION_FILE = "./host_calibration.json"
+
+
+def _hf_cache_dirname(model_name):
+    """Hugging Face 缓存目录名，例如 models--google--gemma-3n-2b"""
+    return "models--" + model_name.replace("/", "--")
+
+
+def find_local_config(model_name, cache_dir="./models_cache", mirror_dir=None):
+    """在本地镜像或缓存目录中查找模型的 config.json"""
+    candidates = []
+
+    if mirror_dir:
+        mirror = Path(mirror_dir)
+        candidates.append(mirror / model_name / "config.json")
+        candidates.append(mirror / model_name.split("/")[-1] / "config.json")
+
+    if cache_dir:
+        snapshots = Path(cache_dir) / _hf_cache_dirname(model_name) / "snapshots"
+        if snapshots.is_dir():
+            # 最新的快照优先
+            for snapshot in sorted(snapshots.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True):
+                candidates.append(snapshot / "config.json")
+
+    for candidate in candidates:
+        if candidate.is_file():
+            return candidate
+
+    return None
+
+
+def load_model_config(config_path):
+    """读取 config.json，返回 (文本解码器配置, 完整配置)"""
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    # Gemma 3N 的多模态配置把文本部分放在 text_config 中
+    text_config = config.get("text_config", config)
+    return text_config, config
+
+
+def _intermediate_sizes(text_config):
+    """每层 FFN 中间维度（Gemma 3N 可能按层给出列表）"""
+    num_layers = text_config["num_hidden_layers"]
+    intermediate = text_config["intermediate_size"]
+    if isinstance(intermediate, list):
+        return intermediate[:num_layers]
+    return [intermediate] * num_layers
+
+
+def _head_dim(text_config):
+    return text_config.get(
+        "head_dim",
+        text_config["hidden_size"] // text_config["num_attention_heads"]
+    )
+
+
+def count_parameters(text_config):
+    """根据配置计算文本解码器参数量，返回分项字典"""
+    hidden = text_config["hidden_size"]
+    num_layers = text_config["num_hidden_layers"]
+    num_heads = text_config["num_attention_heads"]
+    num_kv_heads = text_config.get("num_key_value_heads", num_heads)
+    head_dim = _head_dim(text_config)
+    vocab_size = text_config["vocab_size"]
+
+    embedding = vocab_size * hidden
+    lm_head = 0 if text_config.get("tie_word_embeddings", True) else vocab_size * hidden
+
+    attention = num_layers * (
+        hidden * num_heads * head_dim          # q_proj
+        + 2 * hidden * num_kv_heads * head_dim  # k_proj + v_proj
+        + num_heads * head_dim * hidden         # o_proj
+    )
+    mlp = sum(3 * hidden * size for size in _intermediate_sizes(text_config))
+    norms = num_layers * 4 * hidden + hidden
+
+    # Gemma 3N 特有结构：逐层嵌入、LAuReL、AltUp
+    per_layer = 0
+    per_layer_embedding = 0
+    hidden_per_layer = text_config.get("hidden_size_per_layer_input", 0)
+    if hidden_per_layer:
+        per_layer_vocab = text_config.get("vocab_size_per_layer_input", vocab_size)
+        per_layer_embedding = per_layer_vocab * num_layers * hidden_per_layer
+        per_layer += per_layer_embedding
+        per_layer += hidden * num_layers * hidden_per_layer
+        per_layer += num_layers * 2 * hidden * hidden_per_layer
+    laurel_rank = text_config.get("laurel_rank", 0)
+    if laurel_rank:
+        per_layer += num_layers * 2 * hidden * laurel_rank
+    altup_inputs = text_config.get("altup_num_inputs", 0)
+    if altup_inputs > 1:
+        per_layer += 2 * (altup_inputs - 1) * hidden * hidden
+
+    total = embedding + lm_head + attention + mlp + norms + per_layer
+    return {
+        "embedding": embedding,
+        "lm_head": lm_head,
+        "attention": attention,
+        "mlp": mlp,
+        "norms": norms,
+        "per_layer_extras": per_layer,
+        "per_layer_embedding": per_layer_embedding,
+        "total": total,
+    }
+
+
+def kv_cache_bytes(text_config, context_length, kv_bytes):
+    """给定上下文长度的 KV cache 大小"""
+    num_layers = text_config["num_hidden_layers"]
+    # Gemma 3N 末尾若干层复用前面层的 KV，不单独存储
+    kv_layers = num_layers - text_config.get("num_kv_shared_layers", 0)
+    num_kv_heads = text_config.get("num_key_value_heads", text_config["num_attention_heads"])
+
+    # 滑动窗口层只需缓存窗口内的 token
+    sliding_window = text_config.get("sliding_window")
+    layer_types = text_config.get("layer_types")
+    if sliding_window and layer_types:
+        cached_tokens = sum(
+            min(context_length, sliding_window) if layer_type == "sliding_attention" else context_length
+            for layer_type in layer_types[:kv_layers]
+        )
+    else:
+        cached_tokens = kv_layers * context_length
+
+    return 2 * cached_tokens * num_kv_heads * _head_dim(text_config) * kv_bytes
+
+
+def load_host_calibration(calibration_file=DEFAULT_CALIBRATION_FILE):
+    """读取主机校准结果（有效内存带宽）"""
+    if not calibration_file or not os.path.exists(calibration_file):
+        return None
+
+    with open(calibration_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def decode_bytes_per_token(text_config, scheme="int8", context_length=DEFAULT_CONTEXT_LENGTH):
+    """
+    单 token 解码需要读取的字节数：除查表式嵌入外的全部权重和 KV cache
+    输入嵌入和逐层嵌入表每步只读一行可忽略；嵌入与 LM head 共享时每步都要完整读取，不能扣除
+    校准和估算共用此公式，两者才能相互对应
+    """
+    quant = QUANTIZATION_SCHEMES[scheme]
+    params = count_parameters(text_config)
+    artifact_bytes = int(params["total"] * quant["weight_bytes"] * (1 + ARTIFACT_OVERHEAD_RATIO))
+    lookup_params = params["per_layer_embedding"]
+    if not text_config.get("tie_word_embeddings", True):
+        lookup_params += params["embedding"]
+    embedding_bytes = lookup_params * quant["weight_bytes"]
+    kv_bytes = kv_cache_bytes(text_config, context_length, quant["kv_bytes"])
+    return max(artifact_bytes - embedding_bytes + kv_bytes, 1)
+
+
+def calibrate_host(calibration_file=DEFAULT_CALIBRATION_FILE, text_config=None, measured_tokens_per_sec=None,
+                   scheme="int8", context_length=DEFAULT_CONTEXT_LENGTH):
+    """
+    校准主机有效内存带宽
+    提供模型配置及其实测 tokens/s 时按估算公式反推，否则测量流式读取带宽
+    """
+    if text_config and measured_tokens_per_sec:
+        bytes_per_token = decode_bytes_per_token(text_config, scheme, context_length)
+        bandwidth = bytes_per_token * measured_tokens_per_sec
+        method = "model"
+    else:
+        import numpy as np
+
+        buffer = np.ones(256 * 1024 * 1024 // 8, dtype=np.float64)
+        buffer.sum()  # 预热
+        runs = 5
+        start = time.perf_counter()
+        for _ in range(runs):
+            buffer.sum()
+        elapsed = time.perf_counter() - start
+        bandwidth = buffer.nbytes * runs / elapsed
+        method = "stream_read"
+
+    calibration = {
+        "bandwidth_bytes_per_sec": bandwidth,
+        "method": method,
+        "host": os.uname().nodename if hasattr(os, "uname") else "unknown",
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    with open(calibration_file, 'w', encoding='utf-8') as f:
+        json.dump(calibration, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ 主机校准完成: {bandwidth / 1e9:.1f} GB/s ({method})")
+    return calibration
+
+
+def estimate_resources(text_config, full_config=None, scheme="int8",
+                       context_length=DEFAULT_CONTEXT_LENGTH, calibration=None):
+    """估算单个量化方案下的资源需求（字节）"""
+    if scheme not in QUANTIZATION_SCHEMES:
+        raise ValueError(f"未知的量化方案: {scheme}")
+
+    quant = QUANTIZATION_SCHEMES[scheme]
+    params = count_parameters(text_config)
+    total_params = params["total"]
+
+    artifact_bytes = int(total_params * quant["weight_bytes"] * (1 + ARTIFACT_OVERHEAD_RATIO))
+
+    # 转换流程：torch 源权重 + TF float32 副本 + 转换器常量图 + 输出产物
+    source_dtype = (full_config or {}).get("torch_dtype") or text_config.get("torch_dtype") or "float32"
+    source_bytes = SOURCE_DTYPE_BYTES.get(source_dtype, 4)
+    conversion_peak_bytes = int(
+        total_params * source_bytes
+        + 2 * total_params * 4
+        + artifact_bytes
+        + CONVERSION_OVERHEAD_BYTES
+    )
+
+    kv_bytes = kv_cache_bytes(text_config, context_length, quant["kv_bytes"])
+    # 激活：单 token 解码的隐藏状态可以忽略，主要是 logits
+    activation_bytes = text_config["vocab_size"] * 4
+    resident_bytes = artifact_bytes + kv_bytes + activation_bytes + RUNTIME_OVERHEAD_BYTES
+
+    tokens_per_sec = None
+    if calibration and calibration.get("bandwidth_bytes_per_sec"):
+        # 解码受内存带宽限制
+        bytes_per_token = decode_bytes_per_token(text_config, scheme, context_length)
+        tokens_per_sec = calibration["bandwidth_bytes_per_sec"] / bytes_per_token
+
+    return {
+        "scheme": scheme,
+        "context_length": context_length,
+        "parameters": total_params,
+        "parameter_breakdown": params,
+        "artifact_bytes": artifact_bytes,
+        "conversion_peak_bytes": conversion_peak_bytes,
+        "kv_cache_bytes": kv_bytes,
+        "resident_bytes": resident_bytes,
+        "tokens_per_sec": tokens_per_sec,
+    }
+
+
+def estimate_model(model_name, cache_dir="./models_cache", mirror_dir=None,
+                   schemes=None, context_length=DEFAULT_CONTEXT_LENGTH,
+                   calibration_file=DEFAULT_CALIBRATION_FILE):
+    """估算模型在各量化方案下的资源需求，找不到 config.json 时返回 None"""
+    config_path = find_local_config(model_name, cache_dir, mirror_dir)
+    if config_path is None:
+        return None
+
+    text_config, full_config = load_model_config(config_path)
+    calibration = load_host_calibration(calibration_file)
+
+    return {
+        scheme: estimate_resources(text_config, full_config, scheme, context_length, calibration)
+        for scheme in (schemes or QUANTIZATION_SCHEMES.keys())
+    }
+
+
+def estimate_build_matrix(model_names, cache_dir="./models_cache", mirror_dir=None,
+                          schemes=None, context_length=DEFAULT_CONTEXT_LENGTH,
+                          calibration_file=DEFAULT_CALIBRATION_FILE):
+    """为构建矩阵规划生成 模型 × 量化方案 的估算行"""
+    rows = []
+    for model_name in model_names:
+        estimates = estimate_model(
+            model_name, cache_dir, mirror_dir, schemes, context_length, calibration_file
+        )
+        if estimates is None:
+            print(f"⚠️ 未找到 {model_name} 的 config.json，跳过")
+            continue
+
+        for estimate in estimates.values():
+            rows.append({"model_name": model_name, **estimate})
+
+    return rows
+
+
+def format_bytes(num_bytes):
+    """格式化字节数"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f}TB"
+
+
+def print_build_matrix(rows):
+    """打印估算表格"""
+    header = f"{'模型':<28}{'量化':<6}{'参数量':>10}{'产物':>10}{'转换峰值':>10}{'常驻内存':>10}{'tokens/s':>10}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        tokens_per_sec = f"{row['tokens_per_sec']:.1f}" if row["tokens_per_sec"] else "未校准"
+        print(
+            f"{row['model_name']:<28}{row['scheme']:<6}"
+            f"{row['parameters'] / 1e9:>9.2f}B"
+            f"{format_bytes(row['artifact_bytes']):>10}"
+            f"{format_bytes(row['conversion_peak_bytes']):>10}"
+            f"{format_bytes(row['resident_bytes']):>10}"
+            f"{tokens_per_sec:>10}"
+        )
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="根据 config.json 估算 Gemma 3N 模型资源需求")
+    parser.add_argument("models", nargs="*", help="模型名称，例如 google/gemma-3n-2b-it")
+    parser.add_argument("--cache-dir", default="./models_cache", help="Hugging Face 缓存目录")
+    parser.add_argument("--mirror-dir", default=None, help="本地镜像目录")
+    parser.add_argument("--schemes", nargs="+", default=list(QUANTIZATION_SCHEMES.keys()),
+                        choices=list(QUANTIZATION_SCHEMES.keys()), help="量化方案")
+    parser.add_argument("--context-length", type=int, default=DEFAULT_CONTEXT_LENGTH, help="上下文长度")
+    parser.add_argument("--calibration-file", default=DEFAULT_CALIBRATION_FILE, help="主机校准文件")
+    parser.add_argument("--calibrate", action="store_true", help="先校准主机内存带宽")
+    parser.add_argument("--calibrate-model", default=None,
+                        help="用已实测速度的模型校准（按名称查找其 config.json）")
+    parser.add_argument("--calibrate-scheme", default="int8", choices=list(QUANTIZATION_SCHEMES.keys()),
+                        help="--calibrate-model 实测时的量化方案")
+    parser.add_argument("--measured-tokens-per-sec", type=float, default=None,
+                        help="--calibrate-model 在 --context-length 下的实测 tokens/s")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出")
+    args = parser.parse_args()
+
+    if args.calibrate_model and not args.measured_tokens_per_sec:
+        parser.error("--calibrate-model 需要同时提供 --measured-tokens-per-sec")
+
+    if args.calibrate_model:
+        config_path = find_local_config(args.calibrate_model, args.cache_dir, args.mirror_dir)
+        if config_path is None:
+            print(f"❌ 未找到 {args.calibrate_model} 的 config.json，无法按模型校准")
+            return 1
+        text_config, _ = load_model_config(config_path)
+        calibrate_host(
+            args.calibration_file, text_config, args.measured_tokens_per_sec,
+            args.calibrate_scheme, args.context_length
+        )
+    elif args.calibrate:
+        calibrate_host(args.calibration_file)
+
+    if not args.models:
+        return 0
+
+    rows = estimate_build_matrix(
+        args.models, args.cache_dir, args.mirror_dir,
+        args.schemes, args.context_length, args.calibration_file
+    )
+
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print_build_matrix(rows)
+
+    return 0 if rows else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Gemma 3N 推測解碼草稿模型導出腳本
+從已下載的 checkpoint 派生小型草稿模型（截斷層堆疊或較小的同系列模型），
+與目標模型共享詞彙表，一起導出為 TFLite，並在主機上測量推測解碼的接受率和速度
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+from download_and_convert_model import (
+    add_workspace_arguments,
+    check_dependencies,
+    convert_to_tflite,
+    create_workspace_for_model,
+    download_gemma_model,
+    workspace_options,
+)
+
+TARGET_MODEL_FILE = "gemma_3n_2b_int8.tflite"
+DRAFT_MODEL_FILE = "gemma_3n_draft_int8.tflite"
+SPECULATIVE_INFO_FILE = "speculative_info.json"
+TOKENIZER_DIR = "tokenizer"
+
+DEFAULT_PROMPTS = [
+    "請用一句話介紹台灣。",
+    "What is the capital of France?",
+    "寫一首關於秋天的短詩。",
+    "Explain what a neural network is in simple terms.",
+]
+
+
+def vocab_fingerprint(tokenizer):
+    """詞彙表指紋，用於確認目標模型和草稿模型共享詞彙表"""
+    vocab = tokenizer.get_vocab()
+    payload = json.dumps(sorted(vocab.items(), key=lambda item: item[1]), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def find_decoder_layers(model):
+    """返回 (父模塊, 屬性名)，指向解碼器層的 ModuleList"""
+    for path in ("model.layers", "model.language_model.layers", "language_model.model.layers"):
+        parent = model
+        names = path.split(".")
+        for name in names[:-1]:
+            parent = getattr(parent, name, None)
+            if parent is None:
+                break
+        if parent is not None and hasattr(parent, names[-1]):
+            return parent, names[-1]
+
+    raise ValueError("找不到解碼器層，無法截斷")
+
+
+def check_truncatable(text_config, num_layers):
+    """檢查目標模型能否截斷為 num_layers 層的草稿模型，不能時拋出 ValueError"""
+    # Gemma 3N 的逐層嵌入按總層數分配，截斷後形狀不匹配
+    if getattr(text_config, "hidden_size_per_layer_input", None):
+        raise ValueError("該架構使用逐層嵌入，不支持截斷層堆疊，請改用 --draft-model 指定較小的同系列模型")
+
+    if num_layers >= text_config.num_hidden_layers:
+        raise ValueError(f"草稿層數 {num_layers} 必須小於目標模型層數 {text_config.num_hidden_layers}")
+
+
+def derive_truncated_draft(model, num_layers, save_dir):
+    """
+    保留前 num_layers 層作為草稿模型並保存，返回保存路徑
+    直接在傳入的模型上截斷，避免大模型複製一份佔用雙倍內存
+    """
+    import torch
+
+    text_config = getattr(model.config, "text_config", model.config)
+    check_truncatable(text_config, num_layers)
+
+    parent, attr = find_decoder_layers(model)
+    setattr(parent, attr, torch.nn.ModuleList(list(getattr(parent, attr))[:num_layers]))
+
+    text_config.num_hidden_layers = num_layers
+    if getattr(text_config, "layer_types", None):
+        text_config.layer_types = text_config.layer_types[:num_layers]
+
+    # 共享詞嵌入和 LM head 保持綁定
+    model.tie_weights()
+
+    os.makedirs(save_dir, exist_ok=True)
+    model.save_pretrained(save_dir)
+    return save_dir
+
+
+def _export_single(model, tokenizer, work_dir, output_path, options=None):
+    """
+    通過常規轉換流程導出單個模型並鏈接到目標路徑
+    工作目錄中的產物保留不動，轉換階段標記仍然有效，重新運行時不會從頭轉換
+    """
+    workspace = create_workspace_for_model(model, work_dir, **(options or {}))
+    tflite_path, _ = convert_to_tflite(model, tokenizer, work_dir, workspace)
+    if tflite_path is None:
+        return None
+
+    _link_or_copy(tflite_path, output_path)
+    return output_path
+
+
+def _link_or_copy(src, dst):
+    """硬鏈接產物避免複製數 GB 的文件，跨文件系統時退回到複製"""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+
+    tmp_path = dst + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def export_speculative_pair(model_name="google/gemma-2b", draft_model_name=None, draft_layers=None,
+                            cache_dir="./models", output_dir="./converted_models", options=None):
+    """導出目標模型和草稿模型，並寫入匹配的元數據；options 為轉換工作區的中間產物選項"""
+    from transformers import AutoModelForCausalLM
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    model, tokenizer, _ = download_gemma_model(model_name, cache_dir)
+    if model is None:
+        return None
+
+    target_config = getattr(model.config, "text_config", model.config)
+    target_layers = target_config.num_hidden_layers
+
+    draft_model = None
+    if draft_model_name:
+        draft_model, draft_tokenizer, _ = download_gemma_model(draft_model_name, cache_dir)
+        if draft_model is None:
+            return None
+        if vocab_fingerprint(draft_tokenizer) != vocab_fingerprint(tokenizer):
+            print(f"草稿模型 {draft_model_name} 與目標模型詞彙表不一致，無法用於推測解碼")
+            return None
+        draft_source = draft_model_name
+    else:
+        num_layers = draft_layers or max(1, target_layers // 4)
+        # 在導出目標模型之前檢查，避免等完整轉換結束才發現無法截斷
+        check_truncatable(target_config, num_layers)
+        draft_source = f"{model_name}[:{num_layers}]"
+
+    print("導出目標模型...")
+    target_path = _export_single(
+        model, tokenizer, os.path.join(output_dir, "target_work"), os.path.join(output_dir, TARGET_MODEL_FILE),
+        options
+    )
+    if target_path is None:
+        print("目標模型轉換失敗")
+        return None
+
+    if draft_model is None:
+        # 目標模型已導出，可以就地截斷
+        print(f"截斷目標模型前 {num_layers} 層作為草稿模型...")
+        draft_dir = derive_truncated_draft(model, num_layers, os.path.join(output_dir, "draft_checkpoint"))
+        del model
+        draft_model = AutoModelForCausalLM.from_pretrained(draft_dir, torch_dtype="auto")
+
+    draft_config = getattr(draft_model.config, "text_config", draft_model.config)
+
+    print("導出草稿模型...")
+    draft_path = _export_single(
+        draft_model, tokenizer, os.path.join(output_dir, "draft_work"), os.path.join(output_dir, DRAFT_MODEL_FILE),
+        options
+    )
+    if draft_path is None:
+        print("草稿模型轉換失敗")
+        return None
+
+    # 基準測試只依賴本地分詞器
+    tokenizer.save_pretrained(os.path.join(output_dir, TOKENIZER_DIR))
+
+    fingerprint = vocab_fingerprint(tokenizer)
+    speculative_info = {
+        "target": {
+            "file": TARGET_MODEL_FILE,
+            "model_name": model_name,
+            "num_layers": target_layers,
+        },
+        "draft": {
+            "file": DRAFT_MODEL_FILE,
+            "source": draft_source,
+            "num_layers": draft_config.num_hidden_layers,
+        },
+        "vocab_size": len(tokenizer.get_vocab()),
+        "vocab_sha256": fingerprint,
+        "bos_token_id": tokenizer.bos_token_id,
+        "eos_token_id": tokenizer.eos_token_id,
+        "max_sequence_length": getattr(tokenizer, 'model_max_length', 2048),
+    }
+
+    info_path = os.path.join(output_dir, SPECULATIVE_INFO_FILE)
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(speculative_info, f, ensure_ascii=False, indent=2)
+
+    print(f"推測解碼元數據已保存到: {info_path}")
+    return target_path, draft_path, info_path
+
+
+class TFLiteCausalLM:
+    """TFLite 因果語言模型的簡單包裝：輸入完整序列，返回每個位置的 logits"""
+
+    def __init__(self, model_path):
+        import tensorflow as tf
+
+        interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.runner = interpreter.get_signature_runner()
+        self.input_names = set(self.runner.get_input_details().keys())
+
+    def logits(self, token_ids):
+        import numpy as np
+
+        input_ids = np.array([token_ids], dtype=np.int32)
+        inputs = {"input_ids": input_ids}
+        if "attention_mask" in self.input_names:
+            inputs["attention_mask"] = np.ones_like(input_ids)
+
+        outputs = self.runner(**inputs)
+        return outputs.get("logits", next(iter(outputs.values())))[0]
+
+
+def greedy_decode(model, prompt_ids, max_new_tokens, eos_token_id):
+    """普通貪婪解碼"""
+    sequence = list(prompt_ids)
+    for _ in range(max_new_tokens):
+        next_token = int(model.logits(sequence)[-1].argmax())
+        sequence.append(next_token)
+        if next_token == eos_token_id:
+            break
+
+    return sequence[len(prompt_ids):]
+
+
+def speculative_decode(target, draft, prompt_ids, max_new_tokens, eos_token_id, num_draft_tokens=4):
+    """
+    貪婪推測解碼：草稿模型連續提出 k 個 token，目標模型一次前向驗證
+    輸出與目標模型的貪婪解碼完全一致，返回 (生成的 token, 提出數, 接受數)
+    """
+    sequence = list(prompt_ids)
+    proposed = 0
+    accepted = 0
+
+    while len(sequence) - len(prompt_ids) < max_new_tokens:
+        remaining = max_new_tokens - (len(sequence) - len(prompt_ids))
+        draft_tokens = []
+        draft_sequence = list(sequence)
+        for _ in range(min(num_draft_tokens, remaining)):
+            token = int(draft.logits(draft_sequence)[-1].argmax())
+            draft_tokens.append(token)
+            draft_sequence.append(token)
+            if token == eos_token_id:
+                break
+
+        # 目標模型在 sequence + draft_tokens 上的一次前向給出每個位置的貪婪預測
+        target_logits = target.logits(sequence + draft_tokens)
+        predictions = target_logits[len(sequence) - 1:].argmax(axis=-1)
+
+        num_accepted = 0
+        while num_accepted < len(draft_tokens) and draft_tokens[num_accepted] == int(predictions[num_accepted]):
+            num_accepted += 1
+
+        proposed += len(draft_tokens)
+        accepted += num_accepted
+
+        # 接受匹配的前綴，再追加目標模型在第一個不匹配位置（或全部接受後）的預測
+        new_tokens = draft_tokens[:num_accepted] + [int(predictions[num_accepted])]
+        for token in new_tokens[:remaining]:
+            sequence.append(token)
+            if token == eos_token_id:
+                return sequence[len(prompt_ids):], proposed, accepted
+
+    return sequence[len(prompt_ids):], proposed, accepted
+
+
+def load_prompts(prompts_file=None):
+    """讀取本地提示詞集：每行一條，或 JSON 字符串列表"""
+    if not prompts_file:
+        return list(DEFAULT_PROMPTS)
+
+    with open(prompts_file, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    if prompts_file.endswith(".json"):
+        return json.loads(content)
+    return [line.strip() for line in content.splitlines() if line.strip()]
+
+
+def benchmark_speculative(output_dir="./converted_models", prompts_file=None,
+                          max_new_tokens=64, num_draft_tokens=4):
+    """在提示詞集上比較推測解碼與普通貪婪解碼"""
+    from transformers import AutoTokenizer
+
+    with open(os.path.join(output_dir, SPECULATIVE_INFO_FILE), 'r', encoding='utf-8') as f:
+        speculative_info = json.load(f)
+
+    tokenizer = AutoTokenizer.from_pretrained(os.path.join(output_dir, TOKENIZER_DIR))
+    if vocab_fingerprint(tokenizer) != speculative_info["vocab_sha256"]:
+        print("分詞器與導出元數據不一致")
+        return None
+
+    target = TFLiteCausalLM(os.path.join(output_dir, speculative_info["target"]["file"]))
+    draft = TFLiteCausalLM(os.path.join(output_dir, speculative_info["draft"]["file"]))
+    eos_token_id = speculative_info["eos_token_id"]
+
+    greedy_tokens = 0
+    greedy_time = 0.0
+    speculative_tokens = 0
+    speculative_time = 0.0
+    total_proposed = 0
+    total_accepted = 0
+    mismatches = 0
+
+    for prompt in load_prompts(prompts_file):
+        prompt_ids = tokenizer(prompt)["input_ids"]
+
+        start = time.perf_counter()
+        baseline = greedy_decode(target, prompt_ids, max_new_tokens, eos_token_id)
+        greedy_time += time.perf_counter() - start
+        greedy_tokens += len(baseline)
+
+        start = time.perf_counter()
+        generated, proposed, accepted = speculative_decode(
+            target, draft, prompt_ids, max_new_tokens, eos_token_id, num_draft_tokens
+        )
+        speculative_time += time.perf_counter() - start
+        speculative_tokens += len(generated)
+        total_proposed += proposed
+        total_accepted += accepted
+
+        if generated != baseline:
+            mismatches += 1
+
+    results = {
+        "acceptance_rate": total_accepted / total_proposed if total_proposed else 0.0,
+        "greedy_tokens_per_sec": greedy_tokens / greedy_time if greedy_time else 0.0,
+        "speculative_tokens_per_sec": speculative_tokens / speculative_time if speculative_time else 0.0,
+        "num_draft_tokens": num_draft_tokens,
+        "output_mismatches": mismatches,
+    }
+    results["speedup"] = (
+        results["speculative_tokens_per_sec"] / results["greedy_tokens_per_sec"]
+        if results["greedy_tokens_per_sec"] else 0.0
+    )
+
+    print("\n推測解碼基準測試:")
+    print(f"  草稿 token 數/輪: {num_draft_tokens}")
+    print(f"  接受率: {results['acceptance_rate']:.1%}")
+    print(f"  貪婪解碼: {results['greedy_tokens_per_sec']:.2f} tokens/s")
+    print(f"  推測解碼: {results['speculative_tokens_per_sec']:.2f} tokens/s")
+    print(f"  加速比: {results['speedup']:.2f}x")
+    if mismatches:
+        print(f"  ⚠️ {mismatches} 條提示詞的輸出與貪婪解碼不一致（量化數值誤差）")
+
+    return results
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="導出推測解碼草稿模型並測量接受率")
+    parser.add_argument("--model", default="google/gemma-2b", help="目標模型名稱")
+    parser.add_argument("--draft-model", default=None, help="較小的同系列模型，與目標模型共享詞彙表")
+    parser.add_argument("--draft-layers", type=int, default=None, help="截斷層堆疊時保留的層數")
+    parser.add_argument("--cache-dir", default="./models", help="模型緩存目錄")
+    parser.add_argument("--output-dir", default="./converted_models", help="輸出目錄")
+    parser.add_argument("--benchmark", action="store_true", help="導出後運行基準測試")
+    parser.add_argument("--benchmark-only", action="store_true", help="只對已導出的產物運行基準測試")
+    parser.add_argument("--prompts", default=None, help="本地提示詞文件（每行一條或 JSON 列表）")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="每條提示詞生成的最大 token 數")
+    parser.add_argument("--num-draft-tokens", type=int, default=4, help="每輪草稿 token 數")
+    add_workspace_arguments(parser)
+    args = parser.parse_args()
+
+    if not check_dependencies():
+        return 1
+
+    if not args.benchmark_only:
+        try:
+            result = export_speculative_pair(
+                args.model, args.draft_model, args.draft_layers, args.cache_dir, args.output_dir,
+                workspace_options(args)
+            )
+        except ValueError as e:
+            print(f"草稿模型派生失敗: {e}")
+            return 1
+        if result is None:
+            return 1
+
+    if args.benchmark or args.benchmark_only:
+        if benchmark_speculative(args.output_dir, args.prompts, args.max_new_tokens, args.num_draft_tokens) is None:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,729 @@
+#!/usr/bin/env python3
+"""
+Gemma 3N 多模態編碼器導出腳本
+將視覺和音頻編碼器分別導出為 TFLite，並把預處理融合進模型圖：
+- 圖片：uint8 RGBA 像素 -> 縮放 -> 歸一化 -> 視覺編碼器
+- 音頻：int16 PCM 採樣 + 有效採樣數 -> 對數梅爾特徵和填充掩碼 -> 音頻編碼器
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+
+VISION_ENCODER_FILE = "gemma_3n_vision_encoder.tflite"
+AUDIO_ENCODER_FILE = "gemma_3n_audio_encoder.tflite"
+ENCODERS_INFO_FILE = "encoders_info.json"
+
+# 基準測試用的未融合版本（輸入為預處理後的浮點特徵）
+VISION_BASELINE_FILE = "gemma_3n_vision_encoder_unfused.tflite"
+AUDIO_BASELINE_FILE = "gemma_3n_audio_encoder_unfused.tflite"
+
+# preprocessor_config.json 缺失時的默認值
+DEFAULT_IMAGE_CONFIG = {
+    "size": 768,
+    "rescale_factor": 1 / 255,
+    "do_normalize": False,
+    "image_mean": [0.5, 0.5, 0.5],
+    "image_std": [0.5, 0.5, 0.5],
+}
+DEFAULT_AUDIO_CONFIG = {
+    "sampling_rate": 16000,
+    "feature_size": 128,
+    "frame_length_ms": 32.0,
+    "hop_length_ms": 10.0,
+    "min_frequency": 125.0,
+    "max_frequency": 7600.0,
+    "mel_floor": 1e-5,
+    "preemphasis": 0.97,
+    "preemphasis_htk_flavor": True,
+    "fft_overdrive": True,
+    "input_scale_factor": 1.0,
+    "per_bin_mean": None,
+    "per_bin_stddev": None,
+}
+
+# 與 transformers 特徵提取器對比時允許的對數梅爾最大誤差
+FEATURE_PARITY_TOLERANCE = 1e-2
+
+
+def check_dependencies():
+    """檢查必要的依賴"""
+    required_packages = [
+        'numpy',
+        'tensorflow',
+        'transformers',
+        'torch',
+        'huggingface_hub',
+        'ai_edge_torch'
+    ]
+
+    missing_packages = []
+    for package in required_packages:
+        try:
+            __import__(package)
+        except ImportError:
+            missing_packages.append(package)
+
+    if missing_packages:
+        print(f"缺少依賴包: {', '.join(missing_packages)}")
+        print("請運行: pip install " + " ".join(p.replace('_', '-') for p in missing_packages))
+        return False
+
+    return True
+
+
+def load_preprocessor_config(model_name, cache_dir="./models"):
+    """讀取模型的 preprocessor_config.json，返回 (圖片配置, 音頻配置)"""
+    image_config = dict(DEFAULT_IMAGE_CONFIG)
+    audio_config = dict(DEFAULT_AUDIO_CONFIG)
+
+    try:
+        from huggingface_hub import hf_hub_download
+
+        config_path = hf_hub_download(model_name, "preprocessor_config.json", cache_dir=cache_dir)
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except Exception as e:
+        print(f"無法讀取 preprocessor_config.json，使用默認值: {e}")
+        return image_config, audio_config
+
+    # 多模態處理器可能把兩部分配置分開存放
+    image_section = config.get("image_processor", config)
+    audio_section = config.get("feature_extractor", config)
+
+    size = image_section.get("size")
+    if isinstance(size, dict):
+        size = size.get("height") or size.get("shortest_edge")
+    if size:
+        image_config["size"] = size
+    for key in ("rescale_factor", "do_normalize", "image_mean", "image_std"):
+        if key in image_section:
+            image_config[key] = image_section[key]
+
+    for key in DEFAULT_AUDIO_CONFIG:
+        if key in audio_section:
+            audio_config[key] = audio_section[key]
+
+    return image_config, audio_config
+
+
+def audio_frame_params(audio_config):
+    """計算幀長、幀移和 FFT 長度（採樣點）"""
+    sample_rate = audio_config["sampling_rate"]
+    frame_length = int(round(sample_rate * audio_config["frame_length_ms"] / 1000))
+    hop_length = int(round(sample_rate * audio_config["hop_length_ms"] / 1000))
+
+    fft_length = 1
+    while fft_length < frame_length:
+        fft_length *= 2
+    if audio_config.get("fft_overdrive"):
+        fft_length *= 2
+
+    return frame_length, hop_length, fft_length
+
+
+def build_audio_constants(audio_config, num_samples):
+    """
+    構建對數梅爾特徵所需的常量（numpy）：
+    分幀索引、窗函數、DFT 矩陣和梅爾濾波器組
+    圖內實現和 numpy 基準共用這些常量，保證兩者計算一致
+    """
+    import numpy as np
+
+    frame_length, hop_length, fft_length = audio_frame_params(audio_config)
+    # 與 Gemma 3n 特徵提取器一致：每幀總是取 frame_length + 1 個採樣點，供預加重使用
+    window_span = frame_length + 1
+    num_frames = 1 + (num_samples - window_span) // hop_length
+    frame_starts = (np.arange(num_frames) * hop_length).astype(np.int32)
+    frame_indices = (frame_starts[:, None] + np.arange(window_span)[None, :]).astype(np.int32)
+
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_length) / frame_length)).astype(np.float32)
+
+    # 幀長小於 FFT 長度時等價於零填充，只需保留前 frame_length 行
+    num_bins = fft_length // 2 + 1
+    angles = 2 * np.pi * np.outer(np.arange(frame_length), np.arange(num_bins)) / fft_length
+    dft_real = np.cos(angles).astype(np.float32)
+    dft_imag = -np.sin(angles).astype(np.float32)
+
+    mel_filters = htk_mel_filter_bank(
+        num_bins,
+        audio_config["feature_size"],
+        audio_config["min_frequency"],
+        audio_config["max_frequency"],
+        audio_config["sampling_rate"],
+    )
+
+    feature_size = audio_config["feature_size"]
+    per_bin_mean = audio_config.get("per_bin_mean")
+    per_bin_stddev = audio_config.get("per_bin_stddev")
+
+    return {
+        "frame_indices": frame_indices,
+        "frame_starts": frame_starts,
+        "window": window,
+        "dft_real": dft_real,
+        "dft_imag": dft_imag,
+        "mel_filters": mel_filters,
+        "per_bin_mean": (
+            None if per_bin_mean is None
+            else np.asarray(per_bin_mean, dtype=np.float32).reshape(1, feature_size)
+        ),
+        "per_bin_stddev": (
+            None if per_bin_stddev is None
+            else np.asarray(per_bin_stddev, dtype=np.float32).reshape(1, feature_size)
+        ),
+        "num_frames": num_frames,
+    }
+
+
+def htk_mel_filter_bank(num_bins, num_mels, min_frequency, max_frequency, sample_rate):
+    """HTK 梅爾三角濾波器組，形狀 [num_bins, num_mels]"""
+    import numpy as np
+
+    def hz_to_mel(freq):
+        return 2595.0 * np.log10(1.0 + freq / 700.0)
+
+    def mel_to_hz(mel):
+        return 700.0 * (10 ** (mel / 2595.0) - 1.0)
+
+    fft_freqs = np.linspace(0, sample_rate / 2, num_bins)
+    mel_points = np.linspace(hz_to_mel(min_frequency), hz_to_mel(max_frequency), num_mels + 2)
+    filter_freqs = mel_to_hz(mel_points)
+
+    filters = np.zeros((num_bins, num_mels), dtype=np.float32)
+    for i in range(num_mels):
+        lower, center, upper = filter_freqs[i:i + 3]
+        rising = (fft_freqs - lower) / (center - lower)
+        falling = (upper - fft_freqs) / (upper - center)
+        filters[:, i] = np.maximum(0, np.minimum(rising, falling))
+
+    return filters
+
+
+def numpy_preprocess_image(pixels, image_config):
+    """numpy 基準：uint8 RGBA [1, H, W, 4] -> float32 [1, 3, S, S]"""
+    import numpy as np
+
+    size = image_config["size"]
+    image = pixels[0, :, :, :3].astype(np.float32)
+    height, width = image.shape[:2]
+
+    # 與 F.interpolate(mode="bilinear", align_corners=False) 一致的雙線性縮放
+    def source_coords(out_size, in_size):
+        coords = (np.arange(out_size) + 0.5) * in_size / out_size - 0.5
+        coords = np.clip(coords, 0, in_size - 1)
+        low = np.floor(coords).astype(np.int64)
+        high = np.minimum(low + 1, in_size - 1)
+        return low, high, (coords - low).astype(np.float32)
+
+    y0, y1, wy = source_coords(size, height)
+    x0, x1, wx = source_coords(size, width)
+    top = image[y0][:, x0] * (1 - wx)[None, :, None] + image[y0][:, x1] * wx[None, :, None]
+    bottom = image[y1][:, x0] * (1 - wx)[None, :, None] + image[y1][:, x1] * wx[None, :, None]
+    resized = top * (1 - wy)[:, None, None] + bottom * wy[:, None, None]
+
+    resized = resized * image_config["rescale_factor"]
+    if image_config["do_normalize"]:
+        mean = np.array(image_config["image_mean"], dtype=np.float32)
+        std = np.array(image_config["image_std"], dtype=np.float32)
+        resized = (resized - mean) / std
+
+    return resized.transpose(2, 0, 1)[None].astype(np.float32)
+
+
+def numpy_log_mel(pcm, audio_config, constants):
+    """numpy 基準：int16 PCM [1, N] -> float32 [1, T, n_mels]"""
+    import numpy as np
+
+    samples = pcm[0].astype(np.float32) / 32768.0 * audio_config.get("input_scale_factor", 1.0)
+    frames = samples[constants["frame_indices"]]
+
+    preemphasis = audio_config.get("preemphasis")
+    if preemphasis and audio_config.get("preemphasis_htk_flavor"):
+        # HTK 風格：每幀首個採樣點乘以 (1 - p)，其餘減去前一個採樣點
+        frames = np.concatenate(
+            [frames[:, :1] * (1.0 - preemphasis), frames[:, 1:-1] - preemphasis * frames[:, :-2]],
+            axis=-1,
+        )
+    elif preemphasis:
+        frames = frames[:, 1:] - preemphasis * frames[:, :-1]
+    else:
+        frames = frames[:, :-1]
+
+    frames = frames * constants["window"]
+    real = frames @ constants["dft_real"]
+    imag = frames @ constants["dft_imag"]
+    magnitude = np.sqrt(real * real + imag * imag)
+    mel = magnitude @ constants["mel_filters"]
+
+    log_mel = np.log(np.maximum(mel, audio_config["mel_floor"]))
+    if constants["per_bin_mean"] is not None:
+        log_mel = log_mel - constants["per_bin_mean"]
+    if constants["per_bin_stddev"] is not None:
+        log_mel = log_mel / constants["per_bin_stddev"]
+
+    return log_mel[None].astype(np.float32)
+
+
+def numpy_padding_mask(valid_samples, constants):
+    """numpy 基準：有效採樣數 -> bool [1, T]，True 表示該幀為填充"""
+    import numpy as np
+
+    return (constants["frame_starts"] >= int(np.asarray(valid_samples).reshape(-1)[0]))[None]
+
+
+def transformers_log_mel(pcm, valid_samples, model_name, cache_dir="./models"):
+    """
+    用 transformers 的 Gemma 3n 特徵提取器計算參考特徵
+    返回 (float32 [1, T, n_mels], 填充掩碼 bool [1, T])，掩碼約定與編碼器輸入一致
+    """
+    import numpy as np
+    from transformers import AutoFeatureExtractor
+
+    extractor = AutoFeatureExtractor.from_pretrained(model_name, cache_dir=cache_dir)
+    num_samples = pcm.shape[1]
+    samples = pcm[0, :int(np.asarray(valid_samples).reshape(-1)[0])].astype(np.float32) / 32768.0
+    outputs = extractor(
+        samples,
+        padding="max_length",
+        max_length=num_samples,
+        truncation=True,
+        pad_to_multiple_of=None,
+        return_tensors="np",
+    )
+    # 特徵提取器的掩碼中 True 表示有效幀，音頻塔需要的是取反後的填充掩碼
+    return outputs["input_features"].astype(np.float32), ~outputs["input_features_mask"].astype(bool)
+
+
+def check_feature_parity(features, padding_mask, reference_features, reference_mask):
+    """比較對數梅爾特徵與參考實現（只比較有效幀），誤差超限時拋出異常"""
+    import numpy as np
+
+    if features.shape != reference_features.shape:
+        raise ValueError(f"特徵形狀不一致: {features.shape} != {reference_features.shape}")
+    if not np.array_equal(padding_mask, reference_mask):
+        raise ValueError("填充掩碼與 transformers 特徵提取器不一致")
+
+    valid = ~reference_mask[0]
+    max_diff = float(np.abs(features[0, valid] - reference_features[0, valid]).max()) if valid.any() else 0.0
+    if max_diff > FEATURE_PARITY_TOLERANCE:
+        raise ValueError(f"對數梅爾特徵與 transformers 特徵提取器差異過大: {max_diff:.2e}")
+    return max_diff
+
+
+def build_encoder_modules(model, image_config, audio_config, num_samples):
+    """構建融合預處理的視覺/音頻編碼器模塊及未融合版本"""
+    import torch
+    import torch.nn.functional as F
+
+    # Gemma3nForConditionalGeneration 把多模態塔放在 .model 下
+    backbone = getattr(model, "model", model)
+    constants = build_audio_constants(audio_config, num_samples)
+
+    class VisionEncoder(torch.nn.Module):
+        """float32 [1, 3, S, S] -> 視覺 soft tokens"""
+
+        def __init__(self):
+            super().__init__()
+            self.backbone = backbone
+
+        def forward(self, pixel_values):
+            return self.backbone.get_image_features(pixel_values)
+
+    class FusedVisionEncoder(torch.nn.Module):
+        """uint8 RGBA [1, H, W, 4] -> 視覺 soft tokens"""
+
+        def __init__(self):
+            super().__init__()
+            self.encoder = VisionEncoder()
+            self.size = image_config["size"]
+            self.rescale = image_config["rescale_factor"]
+            self.normalize = image_config["do_normalize"]
+            self.register_buffer("mean", torch.tensor(image_config["image_mean"]).view(1, 3, 1, 1))
+            self.register_buffer("std", torch.tensor(image_config["image_std"]).view(1, 3, 1, 1))
+
+        def forward(self, pixels):
+            x = pixels[..., :3].to(torch.float32).permute(0, 3, 1, 2)
+            x = F.interpolate(x, size=(self.size, self.size), mode="bilinear", align_corners=False)
+            x = x * self.rescale
+            if self.normalize:
+                x = (x - self.mean) / self.std
+            return self.encoder(x)
+
+    class AudioEncoder(torch.nn.Module):
+        """float32 對數梅爾特徵 [1, T, n_mels] + int32 有效採樣數 [1] -> 音頻 soft tokens"""
+
+        def __init__(self):
+            super().__init__()
+            self.backbone = backbone
+            self.register_buffer("frame_starts", torch.from_numpy(constants["frame_starts"]).long())
+
+        def padding_mask(self, valid_samples):
+            # 與特徵提取器的 attention_mask[::hop] 一致：起點落在有效採樣之外的幀為填充
+            # 音頻塔的掩碼約定是 True 表示填充（Gemma3nModel.forward 傳入的是 ~input_features_mask）
+            return (self.frame_starts >= valid_samples.to(torch.long)).unsqueeze(0)
+
+        def forward(self, features, valid_samples):
+            embeddings, _ = self.backbone.get_audio_features(features, self.padding_mask(valid_samples))
+            return embeddings
+
+    class FusedAudioEncoder(torch.nn.Module):
+        """int16 PCM [1, N] + int32 有效採樣數 [1] -> 音頻 soft tokens"""
+
+        def __init__(self):
+            super().__init__()
+            self.encoder = AudioEncoder()
+            self.preemphasis = audio_config.get("preemphasis") or 0.0
+            self.htk_flavor = bool(audio_config.get("preemphasis_htk_flavor"))
+            self.scale = audio_config.get("input_scale_factor", 1.0) / 32768.0
+            self.mel_floor = audio_config["mel_floor"]
+            self.register_buffer("frame_indices", torch.from_numpy(constants["frame_indices"]).long())
+            self.register_buffer("window", torch.from_numpy(constants["window"]))
+            self.register_buffer("dft_real", torch.from_numpy(constants["dft_real"]))
+            self.register_buffer("dft_imag", torch.from_numpy(constants["dft_imag"]))
+            self.register_buffer("mel_filters", torch.from_numpy(constants["mel_filters"]))
+            for name in ("per_bin_mean", "per_bin_stddev"):
+                value = constants[name]
+                self.register_buffer(name, None if value is None else torch.from_numpy(value))
+
+        def log_mel(self, pcm):
+            samples = pcm[0].to(torch.float32) * self.scale
+            # 用常量索引 gather 分幀，避免 unfold/stft 這類轉換器不支持的算子
+            frames = samples[self.frame_indices]
+            if self.preemphasis and self.htk_flavor:
+                frames = torch.cat(
+                    [frames[:, :1] * (1.0 - self.preemphasis),
+                     frames[:, 1:-1] - self.preemphasis * frames[:, :-2]],
+                    dim=-1,
+                )
+            elif self.preemphasis:
+                frames = frames[:, 1:] - self.preemphasis * frames[:, :-1]
+            else:
+                frames = frames[:, :-1]
+            frames = frames * self.window
+            real = frames @ self.dft_real
+            imag = frames @ self.dft_imag
+            magnitude = torch.sqrt(real * real + imag * imag)
+            mel = magnitude @ self.mel_filters
+            features = torch.log(torch.clamp(mel, min=self.mel_floor))
+            if self.per_bin_mean is not None:
+                features = features - self.per_bin_mean
+            if self.per_bin_stddev is not None:
+                features = features / self.per_bin_stddev
+            return features.unsqueeze(0)
+
+        def forward(self, pcm, valid_samples):
+            return self.encoder(self.log_mel(pcm), valid_samples)
+
+    return {
+        "vision": FusedVisionEncoder().eval(),
+        "audio": FusedAudioEncoder().eval(),
+        "vision_unfused": VisionEncoder().eval(),
+        "audio_unfused": AudioEncoder().eval(),
+        "audio_constants": constants,
+    }
+
+
+def export_tflite(module, sample_inputs, output_path):
+    """用 ai_edge_torch 將 PyTorch 模塊導出為 TFLite"""
+    import torch
+    import ai_edge_torch
+
+    with torch.no_grad():
+        edge_model = ai_edge_torch.convert(module, sample_inputs)
+    edge_model.export(output_path)
+
+    print(f"已導出: {output_path} ({os.path.getsize(output_path) / 1024 / 1024:.1f} MB)")
+    return output_path
+
+
+def export_encoders(model_name="google/gemma-3n-e2b-it", cache_dir="./models",
+                    output_dir="./converted_models", image_input_size=None,
+                    audio_seconds=10.0, export_baseline=False):
+    """導出視覺和音頻編碼器，返回產物路徑字典；image_input_size 默認取預處理配置的圖片邊長"""
+    import numpy as np
+    import torch
+    from transformers import AutoModelForImageTextToText
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"正在加載多模態模型: {model_name}")
+    model = AutoModelForImageTextToText.from_pretrained(
+        model_name,
+        cache_dir=cache_dir,
+        torch_dtype=torch.float32
+    )
+    model.eval()
+
+    image_config, audio_config = load_preprocessor_config(model_name, cache_dir)
+    if image_input_size is None:
+        image_input_size = image_config["size"]
+    num_samples = int(audio_config["sampling_rate"] * audio_seconds)
+    modules = build_encoder_modules(model, image_config, audio_config, num_samples)
+    constants = modules["audio_constants"]
+
+    sample_pixels = torch.zeros((1, image_input_size, image_input_size, 4), dtype=torch.uint8)
+    sample_pcm = torch.zeros((1, num_samples), dtype=torch.int16)
+    sample_valid = torch.tensor([num_samples], dtype=torch.int32)
+
+    # 圖內特徵必須和模型訓練時使用的 transformers 特徵提取器一致，否則不導出
+    test_pcm = _load_pcm(None, num_samples, audio_config["sampling_rate"])
+    test_valid = np.array([num_samples * 3 // 4], dtype=np.int32)
+    with torch.no_grad():
+        graph_features = modules["audio"].log_mel(torch.from_numpy(test_pcm)).numpy()
+        graph_mask = modules["audio"].encoder.padding_mask(torch.from_numpy(test_valid)).numpy()
+    reference_features, reference_mask = transformers_log_mel(test_pcm, test_valid, model_name, cache_dir)
+    max_diff = check_feature_parity(graph_features, graph_mask, reference_features, reference_mask)
+    print(f"音頻特徵與 transformers 特徵提取器一致（最大差異 {max_diff:.2e}）")
+
+    print("導出視覺編碼器（融合預處理）...")
+    vision_path = export_tflite(
+        modules["vision"], (sample_pixels,), os.path.join(output_dir, VISION_ENCODER_FILE)
+    )
+    print("導出音頻編碼器（融合對數梅爾特徵）...")
+    audio_path = export_tflite(
+        modules["audio"], (sample_pcm, sample_valid), os.path.join(output_dir, AUDIO_ENCODER_FILE)
+    )
+
+    artifacts = {"vision": vision_path, "audio": audio_path}
+
+    if export_baseline:
+        print("導出未融合的基準編碼器...")
+        size = image_config["size"]
+        artifacts["vision_unfused"] = export_tflite(
+            modules["vision_unfused"],
+            (torch.zeros((1, 3, size, size), dtype=torch.float32),),
+            os.path.join(output_dir, VISION_BASELINE_FILE)
+        )
+        artifacts["audio_unfused"] = export_tflite(
+            modules["audio_unfused"],
+            (torch.zeros((1, constants["num_frames"], audio_config["feature_size"]), dtype=torch.float32),
+             sample_valid),
+            os.path.join(output_dir, AUDIO_BASELINE_FILE)
+        )
+
+    # 應用端按此描述準備原始輸入
+    encoders_info = {
+        "model_name": model_name,
+        "vision": {
+            "file": VISION_ENCODER_FILE,
+            "input": {"dtype": "uint8", "shape": [1, image_input_size, image_input_size, 4], "layout": "RGBA"},
+            "preprocessing": image_config,
+        },
+        "audio": {
+            "file": AUDIO_ENCODER_FILE,
+            "input": {"dtype": "int16", "shape": [1, num_samples], "sampling_rate": audio_config["sampling_rate"]},
+            # 第二個輸入：int32 [1]，實際錄音的採樣數，其後的零填充幀會被掩碼
+            "valid_samples_input": {"dtype": "int32", "shape": [1]},
+            "preprocessing": audio_config,
+        },
+    }
+    info_path = os.path.join(output_dir, ENCODERS_INFO_FILE)
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(encoders_info, f, ensure_ascii=False, indent=2)
+    artifacts["info"] = info_path
+
+    print(f"編碼器信息已保存到: {info_path}")
+    return artifacts
+
+
+def _load_image_pixels(image_path, input_size):
+    """讀取圖片為 uint8 RGBA [1, S, S, 4]，未提供時生成漸變測試圖"""
+    import numpy as np
+
+    if image_path:
+        from PIL import Image
+
+        image = Image.open(image_path).convert("RGBA").resize((input_size, input_size))
+        return np.asarray(image, dtype=np.uint8)[None]
+
+    gradient = np.linspace(0, 255, input_size, dtype=np.float32)
+    pixels = np.zeros((1, input_size, input_size, 4), dtype=np.uint8)
+    pixels[0, :, :, 0] = gradient[None, :]
+    pixels[0, :, :, 1] = gradient[:, None]
+    pixels[0, :, :, 2] = 128
+    pixels[0, :, :, 3] = 255
+    return pixels
+
+
+def _load_pcm(audio_path, num_samples, sample_rate, with_length=False):
+    """
+    讀取 16 位單聲道 WAV 為 int16 [1, N]，未提供時生成帶噪聲的正弦波
+    with_length 為 True 時同時返回有效採樣數 int32 [1]
+    """
+    import numpy as np
+
+    if audio_path:
+        import wave
+
+        with wave.open(audio_path, 'rb') as wav:
+            samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    else:
+        t = np.arange(num_samples) / sample_rate
+        signal = 0.3 * np.sin(2 * np.pi * 440 * t) + 0.05 * np.random.default_rng(0).standard_normal(num_samples)
+        samples = (signal * 32767).astype(np.int16)
+
+    valid = min(num_samples, samples.size)
+    pcm = np.zeros((1, num_samples), dtype=np.int16)
+    pcm[0, :valid] = samples[:num_samples]
+    if with_length:
+        return pcm, np.array([valid], dtype=np.int32)
+    return pcm
+
+
+def _time_runs(fn, runs):
+    """運行多次並返回耗時（毫秒）的統計"""
+    import numpy as np
+
+    fn()  # 預熱
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings = np.array(timings)
+    return {
+        "mean_ms": float(timings.mean()),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p90_ms": float(np.percentile(timings, 90)),
+    }
+
+
+def _make_runner(model_path):
+    """創建單輸出的 TFLite 推理函數，輸入按模型輸入順序傳入"""
+    import tensorflow as tf
+
+    interpreter = tf.lite.Interpreter(model_path=model_path)
+    interpreter.allocate_tensors()
+    input_indices = [detail["index"] for detail in interpreter.get_input_details()]
+    output_index = interpreter.get_output_details()[0]["index"]
+
+    def run(*inputs):
+        for index, value in zip(input_indices, inputs):
+            interpreter.set_tensor(index, value)
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+
+    return run
+
+
+def benchmark_encoders(output_dir="./converted_models", image_path=None, audio_path=None, runs=20,
+                       cache_dir="./models"):
+    """比較融合預處理與 numpy 預處理 + 未融合編碼器的端到端編碼延遲"""
+    import numpy as np
+
+    with open(os.path.join(output_dir, ENCODERS_INFO_FILE), 'r', encoding='utf-8') as f:
+        encoders_info = json.load(f)
+
+    image_config = encoders_info["vision"]["preprocessing"]
+    audio_config = encoders_info["audio"]["preprocessing"]
+    input_size = encoders_info["vision"]["input"]["shape"][1]
+    num_samples = encoders_info["audio"]["input"]["shape"][1]
+
+    pixels = _load_image_pixels(image_path, input_size)
+    pcm, valid_samples = _load_pcm(audio_path, num_samples, audio_config["sampling_rate"], with_length=True)
+    constants = build_audio_constants(audio_config, num_samples)
+
+    # numpy 基準本身也要和 transformers 特徵提取器一致，否則差異對比沒有意義
+    reference_features, reference_mask = transformers_log_mel(
+        pcm, valid_samples, encoders_info["model_name"], cache_dir
+    )
+    feature_diff = check_feature_parity(
+        numpy_log_mel(pcm, audio_config, constants), numpy_padding_mask(valid_samples, constants),
+        reference_features, reference_mask
+    )
+
+    fused_vision = _make_runner(os.path.join(output_dir, VISION_ENCODER_FILE))
+    fused_audio = _make_runner(os.path.join(output_dir, AUDIO_ENCODER_FILE))
+    baseline_vision = _make_runner(os.path.join(output_dir, VISION_BASELINE_FILE))
+    baseline_audio = _make_runner(os.path.join(output_dir, AUDIO_BASELINE_FILE))
+
+    results = {
+        "vision_fused": _time_runs(lambda: fused_vision(pixels), runs),
+        "vision_numpy_baseline": _time_runs(
+            lambda: baseline_vision(numpy_preprocess_image(pixels, image_config)), runs
+        ),
+        "audio_fused": _time_runs(lambda: fused_audio(pcm, valid_samples), runs),
+        "audio_numpy_baseline": _time_runs(
+            lambda: baseline_audio(numpy_log_mel(pcm, audio_config, constants), valid_samples), runs
+        ),
+        "audio_features_vs_transformers": feature_diff,
+    }
+
+    # 數值一致性檢查：兩條路徑的輸出應基本相同
+    results["vision_max_abs_diff"] = float(np.abs(
+        fused_vision(pixels) - baseline_vision(numpy_preprocess_image(pixels, image_config))
+    ).max())
+    results["audio_max_abs_diff"] = float(np.abs(
+        fused_audio(pcm, valid_samples) - baseline_audio(numpy_log_mel(pcm, audio_config, constants), valid_samples)
+    ).max())
+
+    print("\n編碼延遲（毫秒）:")
+    print(f"{'路徑':<24}{'平均':>10}{'P50':>10}{'P90':>10}")
+    for name in ("vision_fused", "vision_numpy_baseline", "audio_fused", "audio_numpy_baseline"):
+        stats = results[name]
+        print(f"{name:<24}{stats['mean_ms']:>10.1f}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}")
+    print(f"視覺輸出最大差異: {results['vision_max_abs_diff']:.2e}")
+    print(f"音頻輸出最大差異: {results['audio_max_abs_diff']:.2e}")
+    print(f"音頻特徵與 transformers 最大差異: {results['audio_features_vs_transformers']:.2e}")
+
+    return results
+
+
+def copy_encoders_to_android_assets(artifacts, android_project_root):
+    """將融合版編碼器及其描述複製到 Android 項目"""
+    models_dir = os.path.join(android_project_root, "app", "src", "main", "assets", "models")
+    os.makedirs(models_dir, exist_ok=True)
+
+    for key in ("vision", "audio", "info"):
+        path = artifacts.get(key)
+        if path and os.path.exists(path):
+            shutil.copy2(path, os.path.join(models_dir, os.path.basename(path)))
+            print(f"已複製到: {os.path.join(models_dir, os.path.basename(path))}")
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="導出融合預處理的 Gemma 3N 視覺/音頻編碼器")
+    parser.add_argument("--model", default="google/gemma-3n-e2b-it", help="多模態模型名稱")
+    parser.add_argument("--cache-dir", default="./models", help="模型緩存目錄")
+    parser.add_argument("--output-dir", default="./converted_models", help="輸出目錄")
+    parser.add_argument("--image-input-size", type=int, default=None,
+                        help="應用端傳入的原始圖片邊長（默認與預處理配置一致，圖內無需縮放）")
+    parser.add_argument("--audio-seconds", type=float, default=10.0, help="音頻輸入固定時長（秒）")
+    parser.add_argument("--android-project-root", default=None, help="複製產物到該 Android 項目")
+    parser.add_argument("--benchmark", action="store_true", help="導出基準模型並運行延遲對比")
+    parser.add_argument("--benchmark-only", action="store_true", help="只對已導出的產物運行基準測試")
+    parser.add_argument("--image", default=None, help="基準測試用圖片")
+    parser.add_argument("--audio", default=None, help="基準測試用 16 位單聲道 WAV")
+    parser.add_argument("--runs", type=int, default=20, help="基準測試運行次數")
+    args = parser.parse_args()
+
+    if not check_dependencies():
+        return 1
+
+    if not args.benchmark_only:
+        try:
+            artifacts = export_encoders(
+                args.model, args.cache_dir, args.output_dir,
+                args.image_input_size, args.audio_seconds, export_baseline=args.benchmark
+            )
+        except Exception as e:
+            print(f"編碼器導出失敗: {e}")
+            return 1
+
+        if args.android_project_root:
+            copy_encoders_to_android_assets(artifacts, args.android_project_root)
+
+    if args.benchmark or args.benchmark_only:
+        benchmark_encoders(args.output_dir, args.image, args.audio, args.runs, args.cache_dir)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -191,6 +191,7 @@ except Exception as e:
 "
     
     if [ $? -eq 0 ]; then
+        python3 build_prompt_tables.py
         echo -e "${GREEN}✅ 模型下载和设置完成${NC}"
     else
         echo -e "${RED}❌ 模型下载失败${NC}"
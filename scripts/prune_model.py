@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Gemma 3N 結構化剪枝腳本
+根據本地校準語料上的激活統計刪除整個 Transformer 塊或收窄 FFN 中間維度，
+每個剪枝檔位都走常規 TFLite 轉換流程，並輸出參數量、文件大小、主機 tokens/s 和困惑度變化
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+
+from download_and_convert_model import (
+    add_workspace_arguments,
+    check_dependencies,
+    convert_to_tflite,
+    create_workspace_for_model,
+    workspace_options,
+)
+from export_draft_model import TFLiteCausalLM, find_decoder_layers, greedy_decode
+
+PRUNING_REPORT_FILE = "pruning_report.json"
+DEFAULT_TIERS = ["base", "drop2", "drop4", "ffn75", "ffn50", "drop2+ffn75"]
+
+
+def parse_tier(spec):
+    """
+    解析剪枝檔位，例如 "drop4"（刪除 4 個塊）、"ffn75"（保留 75% FFN 寬度）、
+    "drop2+ffn75"（組合），"base" 表示不剪枝
+    """
+    tier = {"name": spec, "drop_layers": 0, "ffn_keep": 1.0}
+    if spec == "base":
+        return tier
+
+    for part in spec.split("+"):
+        if part.startswith("drop"):
+            tier["drop_layers"] = int(part[len("drop"):])
+        elif part.startswith("ffn"):
+            tier["ffn_keep"] = int(part[len("ffn"):]) / 100
+        else:
+            raise ValueError(f"無法解析剪枝檔位: {spec}")
+
+    if not 0 < tier["ffn_keep"] <= 1:
+        raise ValueError(f"FFN 保留比例必須在 (0, 100] 之間: {spec}")
+    return tier
+
+
+def load_calibration_batches(corpus_path, tokenizer, seq_len=256, max_batches=64, eval_fraction=0.25):
+    """讀取本地校準語料，切成定長序列，返回 (校準批次, 評估批次)"""
+    with open(corpus_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    token_ids = tokenizer(text, return_tensors="pt")["input_ids"][0]
+    num_chunks = min(len(token_ids) // seq_len, max_batches)
+    if num_chunks < 2:
+        raise ValueError(f"校準語料太短：至少需要 {2 * seq_len} 個 token")
+
+    chunks = [token_ids[i * seq_len:(i + 1) * seq_len].unsqueeze(0) for i in range(num_chunks)]
+    num_eval = max(1, int(num_chunks * eval_fraction))
+    return chunks[num_eval:], chunks[:num_eval]
+
+
+def _get_mlp(layer):
+    mlp = getattr(layer, "mlp", None)
+    if mlp is None or not all(hasattr(mlp, name) for name in ("gate_proj", "up_proj", "down_proj")):
+        return None
+    return mlp
+
+
+def collect_activation_stats(model, batches):
+    """
+    收集激活統計：
+    - 塊重要性：1 - 塊輸入與輸出隱藏狀態的平均余弦相似度（越接近恆等映射越不重要）
+    - FFN 通道重要性：down_proj 輸入激活的平均絕對值 × 對應權重列的範數
+    """
+    import torch
+
+    parent, attr = find_decoder_layers(model)
+    layers = getattr(parent, attr)
+
+    block_scores = [0.0] * len(layers)
+    channel_sums = [None] * len(layers)
+    num_tokens = 0
+    hooks = []
+
+    def block_hook(index):
+        def hook(module, args, kwargs, output):
+            hidden_in = args[0] if args else kwargs["hidden_states"]
+            hidden_out = output[0] if isinstance(output, tuple) else output
+            similarity = torch.nn.functional.cosine_similarity(
+                hidden_in.float(), hidden_out.float(), dim=-1
+            )
+            block_scores[index] += (1 - similarity).sum().item()
+        return hook
+
+    def channel_hook(index):
+        def hook(module, args):
+            activations = args[0].detach().float().abs().reshape(-1, args[0].shape[-1]).sum(dim=0)
+            channel_sums[index] = activations if channel_sums[index] is None else channel_sums[index] + activations
+        return hook
+
+    for index, layer in enumerate(layers):
+        hooks.append(layer.register_forward_hook(block_hook(index), with_kwargs=True))
+        mlp = _get_mlp(layer)
+        if mlp is not None:
+            hooks.append(mlp.down_proj.register_forward_pre_hook(channel_hook(index)))
+
+    model.eval()
+    try:
+        with torch.no_grad():
+            for batch in batches:
+                model(input_ids=batch)
+                num_tokens += batch.numel()
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    channel_scores = []
+    for index, layer in enumerate(layers):
+        mlp = _get_mlp(layer)
+        if mlp is None or channel_sums[index] is None:
+            channel_scores.append(None)
+            continue
+        weight_norms = mlp.down_proj.weight.detach().float().norm(dim=0)
+        channel_scores.append((channel_sums[index] / num_tokens * weight_norms).tolist())
+
+    return {
+        "block_scores": [score / num_tokens for score in block_scores],
+        "channel_scores": channel_scores,
+    }
+
+
+def drop_layers(model, block_scores, num_drop):
+    """刪除重要性最低的 num_drop 個塊（保留首尾塊），返回被刪除的層索引"""
+    import torch
+
+    text_config = getattr(model.config, "text_config", model.config)
+    # Gemma 3N 的逐層嵌入按總層數分配，刪除層後形狀不匹配
+    if getattr(text_config, "hidden_size_per_layer_input", None):
+        raise ValueError("該架構使用逐層嵌入，不支持刪除整個塊，請只使用 ffn 檔位")
+
+    parent, attr = find_decoder_layers(model)
+    layers = list(getattr(parent, attr))
+    if num_drop >= len(layers) - 2:
+        raise ValueError(f"刪除 {num_drop} 個塊後剩餘層數不足（共 {len(layers)} 層）")
+
+    candidates = sorted(range(1, len(layers) - 1), key=lambda index: block_scores[index])
+    dropped = sorted(candidates[:num_drop])
+    kept = [index for index in range(len(layers)) if index not in dropped]
+
+    new_layers = [layers[index] for index in kept]
+    # KV cache 按 layer_idx 索引，刪除後需要重新編號
+    for new_index, layer in enumerate(new_layers):
+        attention = getattr(layer, "self_attn", None)
+        if attention is not None and hasattr(attention, "layer_idx"):
+            attention.layer_idx = new_index
+    setattr(parent, attr, torch.nn.ModuleList(new_layers))
+
+    text_config.num_hidden_layers = len(new_layers)
+    if getattr(text_config, "layer_types", None):
+        text_config.layer_types = [text_config.layer_types[index] for index in kept]
+    if isinstance(getattr(text_config, "intermediate_size", None), list):
+        text_config.intermediate_size = [text_config.intermediate_size[index] for index in kept]
+
+    return dropped
+
+
+def _slice_linear(linear, indices, dim):
+    """按索引切出新的 Linear（dim=0 切輸出，dim=1 切輸入）"""
+    import torch
+
+    weight = linear.weight.detach().index_select(dim, indices)
+    out_features, in_features = weight.shape
+    new_linear = torch.nn.Linear(in_features, out_features, bias=linear.bias is not None,
+                                 dtype=weight.dtype, device=weight.device)
+    new_linear.weight.data.copy_(weight)
+    if linear.bias is not None:
+        bias = linear.bias.detach() if dim == 1 else linear.bias.detach().index_select(0, indices)
+        new_linear.bias.data.copy_(bias)
+    return new_linear
+
+
+def narrow_ffn(model, channel_scores, keep_ratio, layer_indices=None):
+    """
+    每層保留重要性最高的 keep_ratio 比例的 FFN 通道
+    layer_indices 為當前各層在原始模型中的索引（先刪除塊時需要）
+    """
+    import torch
+
+    parent, attr = find_decoder_layers(model)
+    layers = getattr(parent, attr)
+    layer_indices = layer_indices or list(range(len(layers)))
+    new_sizes = []
+
+    for layer, original_index in zip(layers, layer_indices):
+        mlp = _get_mlp(layer)
+        scores = channel_scores[original_index]
+        if mlp is None or scores is None:
+            new_sizes.append(None)
+            continue
+
+        intermediate = mlp.down_proj.in_features
+        keep = max(1, int(round(intermediate * keep_ratio)))
+        indices = torch.tensor(scores).topk(keep).indices.sort().values.to(mlp.down_proj.weight.device)
+
+        mlp.gate_proj = _slice_linear(mlp.gate_proj, indices, dim=0)
+        mlp.up_proj = _slice_linear(mlp.up_proj, indices, dim=0)
+        mlp.down_proj = _slice_linear(mlp.down_proj, indices, dim=1)
+        if hasattr(mlp, "intermediate_size"):
+            mlp.intermediate_size = keep
+        new_sizes.append(keep)
+
+    text_config = getattr(model.config, "text_config", model.config)
+    if isinstance(text_config.intermediate_size, list):
+        text_config.intermediate_size = [
+            size if size is not None else original
+            for size, original in zip(new_sizes, text_config.intermediate_size)
+        ]
+    else:
+        known_sizes = {size for size in new_sizes if size is not None}
+        if len(known_sizes) > 1:
+            # 配置只能表示統一寬度，按層不同時改用列表
+            text_config.intermediate_size = new_sizes
+        elif known_sizes:
+            text_config.intermediate_size = known_sizes.pop()
+
+
+def perplexity(model, batches):
+    """在評估批次上計算困惑度"""
+    import torch
+
+    total_loss = 0.0
+    total_tokens = 0
+    model.eval()
+    with torch.no_grad():
+        for batch in batches:
+            loss = model(input_ids=batch, labels=batch).loss
+            # labels 會右移一位，有效 token 數為 seq_len - 1
+            total_loss += loss.item() * (batch.shape[1] - 1)
+            total_tokens += batch.shape[1] - 1
+
+    return math.exp(total_loss / total_tokens)
+
+
+def measure_tokens_per_sec(tflite_path, prompt_ids, max_new_tokens=32):
+    """用 TFLite 解釋器在主機上測量貪婪解碼速度"""
+    model = TFLiteCausalLM(tflite_path)
+    model.logits(prompt_ids)  # 預熱
+
+    start = time.perf_counter()
+    generated = greedy_decode(model, prompt_ids, max_new_tokens, eos_token_id=None)
+    elapsed = time.perf_counter() - start
+    return len(generated) / elapsed if elapsed else 0.0
+
+
+def build_tier(model_name, tier, stats, tokenizer, eval_batches, output_dir, cache_dir="./models",
+               options=None):
+    """加載基礎模型、應用剪枝檔位、計算困惑度並導出為 TFLite；options 為轉換工作區的中間產物選項"""
+    from transformers import AutoModelForCausalLM
+
+    tier_dir = os.path.join(output_dir, "tiers", tier["name"].replace("+", "_"))
+    checkpoint_dir = os.path.join(tier_dir, "checkpoint")
+
+    # 每個檔位都從基礎模型重新加載，檔位之間互不影響
+    model = AutoModelForCausalLM.from_pretrained(model_name, cache_dir=cache_dir, torch_dtype="auto")
+
+    kept_indices = None
+    dropped = []
+    if tier["drop_layers"]:
+        dropped = drop_layers(model, stats["block_scores"], tier["drop_layers"])
+        kept_indices = [index for index in range(len(stats["block_scores"])) if index not in dropped]
+    if tier["ffn_keep"] < 1.0:
+        narrow_ffn(model, stats["channel_scores"], tier["ffn_keep"], kept_indices)
+
+    num_params = sum(parameter.numel() for parameter in model.parameters())
+    tier_ppl = perplexity(model, eval_batches)
+
+    # 保存剪枝後的 checkpoint，常規轉換流程從該目錄重新加載
+    model.save_pretrained(checkpoint_dir)
+    tokenizer.save_pretrained(checkpoint_dir)
+    del model
+    model = AutoModelForCausalLM.from_pretrained(checkpoint_dir, torch_dtype="auto")
+
+    workspace = create_workspace_for_model(model, tier_dir, **(options or {}))
+    tflite_path, _ = convert_to_tflite(model, tokenizer, tier_dir, workspace)
+
+    return {
+        "tier": tier["name"],
+        "dropped_layers": dropped,
+        "ffn_keep": tier["ffn_keep"],
+        "parameters": num_params,
+        "perplexity": tier_ppl,
+        "tflite": tflite_path,
+        "file_size": os.path.getsize(tflite_path) if tflite_path else None,
+    }
+
+
+def run_pruning(model_name, corpus_path, tier_specs=None, output_dir="./converted_models/pruned",
+                cache_dir="./models", seq_len=256, max_new_tokens=32, options=None):
+    """為每個剪枝檔位導出模型並生成對比表"""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tiers = [parse_tier(spec) for spec in (tier_specs or DEFAULT_TIERS)]
+    os.makedirs(output_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir)
+    calibration_batches, eval_batches = load_calibration_batches(corpus_path, tokenizer, seq_len)
+
+    print(f"在 {len(calibration_batches)} 個校準序列上收集激活統計...")
+    base_model = AutoModelForCausalLM.from_pretrained(model_name, cache_dir=cache_dir, torch_dtype="auto")
+    stats = collect_activation_stats(base_model, calibration_batches)
+    base_ppl = perplexity(base_model, eval_batches)
+    del base_model
+
+    with open(os.path.join(output_dir, "activation_stats.json"), 'w', encoding='utf-8') as f:
+        json.dump({"block_scores": stats["block_scores"]}, f, indent=2)
+
+    prompt_ids = eval_batches[0][0, :32].tolist()
+    rows = []
+    for tier in tiers:
+        print(f"\n=== 剪枝檔位: {tier['name']} ===")
+        try:
+            row = build_tier(model_name, tier, stats, tokenizer, eval_batches, output_dir, cache_dir, options)
+        except ValueError as e:
+            print(f"跳過檔位 {tier['name']}: {e}")
+            continue
+
+        row["perplexity_delta"] = row["perplexity"] - base_ppl
+        row["tokens_per_sec"] = (
+            measure_tokens_per_sec(row["tflite"], prompt_ids, max_new_tokens) if row["tflite"] else None
+        )
+        rows.append(row)
+
+    report = {"model_name": model_name, "base_perplexity": base_ppl, "tiers": rows}
+    with open(os.path.join(output_dir, PRUNING_REPORT_FILE), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_pruning_table(rows)
+    return report
+
+
+def print_pruning_table(rows):
+    """打印剪枝檔位對比表"""
+    header = f"{'檔位':<16}{'參數量':>10}{'文件大小':>12}{'tokens/s':>10}{'困惑度':>10}{'變化':>10}"
+    print("\n" + header)
+    print("-" * len(header))
+    for row in rows:
+        file_size = f"{row['file_size'] / 1024 / 1024:.1f}MB" if row["file_size"] else "失敗"
+        tokens_per_sec = f"{row['tokens_per_sec']:.2f}" if row["tokens_per_sec"] else "-"
+        print(
+            f"{row['tier']:<16}{row['parameters'] / 1e9:>9.2f}B{file_size:>12}{tokens_per_sec:>10}"
+            f"{row['perplexity']:>10.2f}{row['perplexity_delta']:>+10.2f}"
+        )
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(description="結構化剪枝並導出各檔位 TFLite 模型")
+    parser.add_argument("--model", default="google/gemma-2b", help="基礎模型名稱")
+    parser.add_argument("--corpus", required=True, help="本地校準語料（純文本）")
+    parser.add_argument("--tiers", nargs="+", default=DEFAULT_TIERS,
+                        help="剪枝檔位，例如 base drop4 ffn75 drop2+ffn75")
+    parser.add_argument("--cache-dir", default="./models", help="模型緩存目錄")
+    parser.add_argument("--output-dir", default="./converted_models/pruned", help="輸出目錄")
+    parser.add_argument("--seq-len", type=int, default=256, help="校準序列長度")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="測速時生成的 token 數")
+    add_workspace_arguments(parser)
+    args = parser.parse_args()
+
+    if not check_dependencies():
+        return 1
+
+    try:
+        run_pruning(
+            args.model, args.corpus, args.tiers, args.output_dir,
+            args.cache_dir, args.seq_len, args.max_new_tokens, workspace_options(args)
+        )
+    except ValueError as e:
+        print(f"剪枝失敗: {e}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -121,6 +121,8 @@ create_placeholder() {
 }
 EOF
     
+    python3 build_prompt_tables.py
+    
     echo -e "${GREEN}✅ 佔位符文件已創建${NC}"
     echo -e "${YELLOW}📝 注意：這些是佔位符文件，應用可以編譯但需要真實模型才能正常工作${NC}"
 }